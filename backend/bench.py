@@ -0,0 +1,736 @@
+"""Latency and throughput benchmark for the API routes.
+
+Seeds a realistic data set (several businesses, one hot queue with many entries),
+drives a concurrent mixed workload through the same ASGITransport client as
+test.py and writes per-route results to a JSON file that can be compared
+between commits.
+
+    python bench.py run [--entries 10000] [--concurrency 50] [--duration 30] [--seed N] [--out bench_results.json]
+    python bench.py dispatch [--waiting 5000] [--desks 1,2,4,8,16]
+    python bench.py surge [--surge 1000] [--cold-queues 10]
+    python bench.py encode [--items 10000] [--repeat 20]
+    python bench.py coldstart [--runs 5] [--burst 50]
+    python bench.py compare old.json new.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from uuid import uuid4
+
+import httpx
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from fastapi.encoders import jsonable_encoder
+from httpx import ASGITransport
+from jose import jwk, jwt
+from prisma import models
+
+import main as api
+from main import (
+    app,
+    db,
+    current_phases,
+    queue_json,
+    user_json,
+    FastJSONResponse,
+    ARCHIVE_SOURCES,
+    DB_POOL_SIZE,
+    JOIN_RATE_PER_QUEUE,
+    JOIN_BURST_PER_QUEUE,
+    QUEUE_DB_SHARE,
+)
+
+GREEN = "\033[92m"
+RED = "\033[91m"
+YELLOW = "\033[93m"
+ENDC = "\033[0m"
+
+# Weights of the mixed workload, roughly what a busy day looks like: mostly customers
+# checking their place, a steady trickle of joins and serves, occasional admin views.
+# Left out on purpose: the admin signup/login routes (the same code as the user ones),
+# creating businesses and queues (rare, and a plain insert), the SSE stream (a long-lived
+# connection, not a request; test_feed.py covers it) and the health, metrics and cache
+# stats endpoints.
+WORKLOAD = {
+    "get_position": 40,
+    "join_queue": 15,
+    "change_status_user": 10,
+    "check_status_user": 8,
+    "dispatch_next": 5,
+    "leave_queue": 5,
+    "get_queue": 5,
+    "get_business": 5,
+    "get_all_business_queues": 4,
+    "get_all_users_queues": 4,
+    "notify_user": 3,
+    "get_user": 2,
+    "analytics": 2,
+    "change_status_users": 2,
+    "join_queue_batch": 2,
+    "user_login": 2,
+    "user_signup": 1,
+    "close_queue": 1,
+}
+BATCH_SIZE = 10
+
+#--------------- SEEDING ---------------#
+
+async def seed_users(count):
+    """Ids of `count` bench users, creating any that do not exist yet."""
+    await db.user.create_many(
+        data=[
+            {"clerkUserId": f"bench_user_{i}", "name": f"Bench {i}", "email": f"bench{i}@test.com"}
+            for i in range(count)
+        ],
+        skip_duplicates=True,
+    )
+    users = await db.user.find_many(
+        where={"clerkUserId": {"startswith": "bench_user_"}}, order={"id": "asc"}, take=count
+    )
+    return [u.id for u in users]
+
+async def seed(args):
+    run_id = uuid4().hex[:8]
+    total_users = args.entries + args.joiners
+    now = datetime.now(timezone.utc)
+    user_ids = await seed_users(total_users)
+
+    businesses = []
+    queues = []
+    for b in range(args.businesses):
+        business = await db.business.create(
+            data={"id": str(uuid4()), "name": f"Bench {run_id} #{b}", "ownerId": user_ids[0]}
+        )
+        businesses.append(business.id)
+        for q in range(args.queues):
+            queue = await db.queue.create(
+                data={"id": str(uuid4()), "title": f"Queue {q}", "businessId": business.id}
+            )
+            queues.append(queue.id)
+
+    # Cold queues get a modest history each, the hot queue gets the full entry count
+    hot_queue = queues[0]
+    waiting = []
+    for queue_id in queues:
+        size = args.entries if queue_id == hot_queue else min(args.entries, 200)
+        rows = []
+        for ticket, user_id in enumerate(user_ids[:size], start=1):
+            joined_at = now - timedelta(minutes=size - ticket)
+            status = "waiting" if ticket > size // 2 else random.choice(["served", "served", "skipped"])
+            row = {
+                "queueId": queue_id,
+                "userId": user_id,
+                "position": ticket,
+                "status": status,
+                "joinedAt": joined_at,
+            }
+            if status == "served":
+                row["servedAt"] = joined_at + timedelta(minutes=random.randint(1, 30))
+            elif status == "skipped":
+                row["skippedAt"] = joined_at + timedelta(minutes=random.randint(1, 30))
+            elif queue_id == hot_queue:
+                waiting.append(user_id)
+            rows.append(row)
+        for start in range(0, len(rows), 5000):
+            await db.queueentry.create_many(data=rows[start:start + 5000])
+        await db.queue.update(where={"id": queue_id}, data={"lastTicket": size})
+
+    # Every fourth cold queue is closed and archived the way the archiver would, so
+    # QueueEntryHistory is as big as a long-running deployment's
+    archived = queues[1::4]
+    await db.queue.update_many(
+        where={"id": {"in": archived}}, data={"closedAt": now - timedelta(hours=1)}
+    )
+    while await db.execute_raw(ARCHIVE_SOURCES["closed"], 0, 50000):
+        pass
+
+    return {
+        "businesses": businesses,
+        "queues": queues,
+        "hot_queue": hot_queue,
+        "archived": archived,
+        "users": user_ids[:args.entries],
+        "joiners": user_ids[args.entries:],
+        "waiting": waiting,
+    }
+
+#--------------- CLERK STUB ---------------#
+
+class ClerkStub:
+    """Answers the Clerk endpoints main.py calls, in process, so the auth routes can join the mix.
+
+    Like the stub in bench_auth.py it serves a JWKS and user profiles, but through an
+    httpx.MockTransport, so there is no server to start and no network in the numbers.
+    """
+
+    def __init__(self):
+        private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        self.private_pem = private_key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption(),
+        ).decode()
+        public_pem = private_key.public_key().public_bytes(
+            serialization.Encoding.PEM,
+            serialization.PublicFormat.SubjectPublicKeyInfo,
+        ).decode()
+        self.public_jwk = {**jwk.construct(public_pem, "RS256").to_dict(), "kid": "bench", "use": "sig"}
+        self.tokens = {}
+
+    def token(self, clerk_id: str) -> str:
+        if clerk_id not in self.tokens:
+            now = int(time.time())
+            self.tokens[clerk_id] = jwt.encode(
+                {"sub": clerk_id, "sid": f"sess_{clerk_id}", "iat": now, "exp": now + 3600},
+                self.private_pem,
+                algorithm="RS256",
+                headers={"kid": "bench"},
+            )
+        return self.tokens[clerk_id]
+
+    def handle(self, request: httpx.Request) -> httpx.Response:
+        path = request.url.path
+        if path.endswith("/jwks"):
+            return httpx.Response(200, json={"keys": [self.public_jwk]})
+        if path.startswith("/v1/users/"):
+            clerk_id = path.rsplit("/", 1)[1]
+            return httpx.Response(200, json={
+                "id": clerk_id,
+                "first_name": "Bench",
+                "last_name": clerk_id,
+                "email_addresses": [{"email_address": f"{clerk_id}@test.com"}],
+            })
+        return httpx.Response(404)
+
+    def install(self):
+        # Local verification against this stub's key, whatever the environment configures
+        api.CLERK_AUTH_MODE = "local"
+        api.CLERK_JWT_PUBLIC_KEY = None
+        api.clerk_jwks.update({"keys": {}, "fetched_at": 0.0})
+        api.clerk_profiles.clear()
+        api.clerk_client = httpx.AsyncClient(base_url=api.CLERK_API_URL, transport=httpx.MockTransport(self.handle))
+
+#--------------- WORKLOAD ---------------#
+
+def pick_request(data):
+    """Return (route name, method, url, json body, headers) for one random request of the mix."""
+    route = random.choices(list(WORKLOAD), weights=list(WORKLOAD.values()))[0]
+    hot = data["hot_queue"]
+
+    if route == "join_queue":
+        if not data["joiners"]:
+            return pick_request(data)
+        user_id = data["joiners"].pop()
+        data["waiting"].append(user_id)
+        return route, "POST", f"/user/queues/{hot}/join/{user_id}", None, None
+    if route == "join_queue_batch":
+        if not data["joiners"]:
+            return pick_request(data)
+        user_ids = [data["joiners"].pop() for _ in range(min(BATCH_SIZE, len(data["joiners"])))]
+        data["waiting"].extend(user_ids)
+        return route, "POST", f"/admin/queues/{hot}/join", {"userIds": user_ids}, None
+    if route in ("change_status_user", "leave_queue", "dispatch_next"):
+        if not data["waiting"]:
+            return pick_request(data)
+        user_id = data["waiting"].pop(0 if route != "leave_queue" else random.randrange(len(data["waiting"])))
+        if route == "leave_queue":
+            return route, "POST", f"/admin/queues/{hot}/leave/{user_id}", None, None
+        if route == "dispatch_next":
+            # Serves whoever is at the head, which is the user popped here
+            return route, "POST", f"/admin/queues/{hot}/next", None, None
+        return route, "PATCH", f"/admin/queues/{hot}/status/{user_id}", {"status": "served"}, None
+    if route == "change_status_users":
+        if not data["waiting"]:
+            return pick_request(data)
+        served = data["waiting"][:BATCH_SIZE]
+        del data["waiting"][:BATCH_SIZE]
+        updates = [{"userId": user_id, "status": "served"} for user_id in served]
+        return route, "PATCH", f"/admin/queues/{hot}/status", {"updates": updates}, None
+    if route == "get_position":
+        user_id = random.choice(data["waiting"] or data["users"])
+        return route, "GET", f"/user/queues/{hot}/position/{user_id}", None, None
+    if route == "notify_user":
+        # Mostly people near the head, where the route has work to do
+        user_id = random.choice(data["waiting"][:20] or data["users"])
+        return route, "POST", f"/user/queues/{hot}/notify/{user_id}", None, None
+    if route == "check_status_user":
+        return route, "GET", f"/admin/queues/{hot}/status/{random.choice(data['users'])}", None, None
+    if route == "close_queue":
+        if not data["open_queues"]:
+            return pick_request(data)
+        queue_id = data["open_queues"].pop(random.randrange(len(data["open_queues"])))
+        return route, "POST", f"/admin/queues/{queue_id}/close", None, None
+    if route == "user_signup":
+        clerk_id = f"bench_clerk_{data['run_id']}_{len(data['signed_up'])}"
+        data["signed_up"].append(clerk_id)
+        return route, "POST", "/user/signup", None, {"Authorization": f"Bearer {data['clerk'].token(clerk_id)}"}
+    if route == "user_login":
+        if not data["signed_up"]:
+            return pick_request(data)
+        clerk_id = random.choice(data["signed_up"])
+        return route, "POST", "/user/login", None, {"Authorization": f"Bearer {data['clerk'].token(clerk_id)}"}
+    if route == "get_queue":
+        return route, "GET", f"/admin/queues/{random.choice(data['queues'])}", None, None
+    if route == "get_business":
+        return route, "GET", f"/admin/business/{random.choice(data['businesses'])}", None, None
+    if route == "get_all_business_queues":
+        return route, "GET", f"/admin/business/{random.choice(data['businesses'])}/queues", None, None
+    if route == "get_all_users_queues":
+        return route, "GET", f"/admin/users/{random.choice(data['users'])}/queues", None, None
+    if route == "get_user":
+        return route, "GET", f"/admin/users/{random.choice(data['users'])}", None, None
+    return route, "GET", f"/admin/analytics/{random.choice(data['businesses'])}", None, None
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+def summarize(samples, elapsed):
+    results = {}
+    for route, rows in sorted(samples.items()):
+        # Fast 429s and other 4xx answers would flatter the percentiles, so only 2xx count there
+        latencies = sorted(r[0] for r in rows if r[2] < 400)
+        queries = [r[1] for r in rows]
+        results[route] = {
+            "requests": len(rows),
+            "errors": sum(1 for r in rows if r[2] >= 500),
+            "rejected_429": sum(1 for r in rows if r[2] == 429),
+            "client_errors": sum(1 for r in rows if 400 <= r[2] < 500 and r[2] != 429),
+            "throughput_rps": len(latencies) / elapsed,
+            "p50_ms": percentile(latencies, 50),
+            "p95_ms": percentile(latencies, 95),
+            "p99_ms": percentile(latencies, 99),
+            "mean_db_queries": statistics.mean(queries),
+            "max_db_queries": max(queries),
+        }
+    return results
+
+async def run_workload(ac, data, args):
+    samples = {}
+    deadline = time.perf_counter() + args.duration
+
+    async def worker():
+        while time.perf_counter() < deadline:
+            route, method, url, body, headers = pick_request(data)
+            # The metrics middleware adds its per-phase totals to the dict we hand it
+            phases = {}
+            token = current_phases.set(phases)
+            start = time.perf_counter()
+            try:
+                resp = await ac.request(method, url, json=body, headers=headers)
+                status = resp.status_code
+            except Exception:
+                status = 599
+            finally:
+                current_phases.reset(token)
+            queries = phases.get("db", [0])[0]
+            samples.setdefault(route, []).append(((time.perf_counter() - start) * 1000, queries, status))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    return summarize(samples, time.perf_counter() - start)
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def ms_cell(value, width):
+    return f"{'-':>{width}}" if value is None else f"{value:>{width}.2f}"
+
+def print_table(results):
+    print(f"{YELLOW}{'route':<26}{'reqs':>7}{'ok rps':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'db/req':>8}"
+          f"{'429':>7}{'4xx':>7}{'errors':>8}{ENDC}")
+    for route, r in results.items():
+        color = RED if r["errors"] else GREEN
+        print(
+            f"{route:<26}{r['requests']:>7}{r['throughput_rps']:>9.1f}{ms_cell(r['p50_ms'], 10)}"
+            f"{ms_cell(r['p95_ms'], 10)}{ms_cell(r['p99_ms'], 10)}{r['mean_db_queries']:>8.1f}"
+            f"{YELLOW if r['rejected_429'] else ''}{r['rejected_429']:>7}{ENDC}{r['client_errors']:>7}"
+            f"{color}{r['errors']:>8}{ENDC}"
+        )
+
+async def run(args):
+    # Seeded so two runs see the same data and the same sequence of requests; the report
+    # records the seed, and concurrency still decides the exact interleaving
+    if args.seed is None:
+        args.seed = random.randrange(2**32)
+    random.seed(args.seed)
+    await db.connect()
+    print(f"Seeding {args.businesses} businesses x {args.queues} queues, hot queue with {args.entries} entries "
+          f"(seed {args.seed})...")
+    data = await seed(args)
+    data["clerk"] = ClerkStub()
+    data["clerk"].install()
+    data["run_id"] = uuid4().hex[:8]
+    data["signed_up"] = []
+    archived = set(data["archived"])
+    data["open_queues"] = [q for q in data["queues"] if q != data["hot_queue"] and q not in archived]
+
+    transport = ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as ac:
+        print(f"Running mixed workload: {args.concurrency} concurrent clients for {args.duration}s\n")
+        results = await run_workload(ac, data, args)
+    await api.clerk_client.aclose()
+    await db.disconnect()
+
+    print_table(results)
+    write_report(args, "routes", results)
+
+def write_report(args, key, results):
+    report = {
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "config": {k: v for k, v in vars(args).items() if k not in ("command", "func")},
+        key: results,
+    }
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults written to {args.out}")
+
+#--------------- DISPATCH ---------------#
+
+async def seed_waiting_queue(size):
+    """A fresh queue with `size` waiting bench users, returning its id."""
+    user_ids = await seed_users(size)
+    business = await db.business.create(data={"id": str(uuid4()), "name": "Bench dispatch", "ownerId": user_ids[0]})
+    queue = await db.queue.create(
+        data={"id": str(uuid4()), "title": "Dispatch", "businessId": business.id, "lastTicket": size}
+    )
+    rows = [
+        {"queueId": queue.id, "userId": user_id, "position": ticket, "status": "waiting"}
+        for ticket, user_id in enumerate(user_ids, start=1)
+    ]
+    for start in range(0, len(rows), 5000):
+        await db.queueentry.create_many(data=rows[start:start + 5000])
+    return queue.id
+
+async def run_dispatch(args):
+    await db.connect()
+    desk_counts = [int(d) for d in args.desks.split(",")]
+    results = []
+
+    transport = ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as ac:
+        print(f"{YELLOW}{'desks':>6}{'served':>8}{'per sec':>10}{'p50 ms':>10}{'p99 ms':>10}{'double-served':>15}{ENDC}")
+        for desks in desk_counts:
+            queue_id = await seed_waiting_queue(args.waiting)
+            served = []
+            latencies = []
+
+            async def desk():
+                while True:
+                    start = time.perf_counter()
+                    resp = await ac.post(f"/admin/queues/{queue_id}/next")
+                    if resp.status_code != 200:
+                        return
+                    latencies.append((time.perf_counter() - start) * 1000)
+                    served.append(resp.json()["userId"])
+
+            start = time.perf_counter()
+            await asyncio.gather(*(desk() for _ in range(desks)))
+            elapsed = time.perf_counter() - start
+
+            latencies.sort()
+            double_served = len(served) - len(set(served))
+            row = {
+                "desks": desks,
+                "served": len(served),
+                "dispatch_per_s": len(served) / elapsed,
+                "p50_ms": percentile(latencies, 50),
+                "p99_ms": percentile(latencies, 99),
+                "double_served": double_served,
+            }
+            results.append(row)
+            color = RED if double_served or len(served) != args.waiting else GREEN
+            print(
+                f"{desks:>6}{len(served):>8}{row['dispatch_per_s']:>10.1f}{row['p50_ms']:>10.2f}"
+                f"{row['p99_ms']:>10.2f}{color}{double_served:>15}{ENDC}"
+            )
+    await db.disconnect()
+    write_report(args, "dispatch", results)
+
+#--------------- SURGE ---------------#
+
+async def run_surge(args):
+    """A hot queue opens to `surge` simultaneous joins while other queues keep their normal trickle.
+
+    Reports how many hot joins were admitted or turned away with 429, and how much the
+    cold queues' join latency moved compared to a quiet baseline.
+    """
+    await db.connect()
+    user_ids = await seed_users(args.surge + 2 * args.cold_queues * args.cold_joins)
+    business = await db.business.create(data={"id": str(uuid4()), "name": "Bench surge", "ownerId": user_ids[0]})
+    queue_ids = []
+    for title in ["Hot"] + [f"Cold {i}" for i in range(args.cold_queues)]:
+        queue = await db.queue.create(data={"id": str(uuid4()), "title": title, "businessId": business.id})
+        queue_ids.append(queue.id)
+    hot, cold = queue_ids[0], queue_ids[1:]
+    surge_users = user_ids[:args.surge]
+    spare_users = user_ids[args.surge:]
+
+    transport = ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as ac:
+
+        async def cold_trickle():
+            latencies = []
+            for queue_id in cold:
+                for _ in range(args.cold_joins):
+                    user_id = spare_users.pop()
+                    start = time.perf_counter()
+                    resp = await ac.post(f"/user/queues/{queue_id}/join/{user_id}")
+                    latencies.append((time.perf_counter() - start) * 1000)
+                    assert resp.status_code == 200, resp.text
+            return sorted(latencies)
+
+        baseline = await cold_trickle()
+
+        async def hot_join(user_id):
+            start = time.perf_counter()
+            resp = await ac.post(f"/user/queues/{hot}/join/{user_id}")
+            return resp.status_code, resp.headers.get("retry-after"), (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        hot_results, during = await asyncio.gather(
+            asyncio.gather(*(hot_join(user_id) for user_id in surge_users)),
+            cold_trickle(),
+        )
+        elapsed = time.perf_counter() - start
+    await db.disconnect()
+
+    admitted = sorted(ms for code, _, ms in hot_results if code == 200)
+    rejected = [(retry, ms) for code, retry, ms in hot_results if code == 429]
+    errors = sum(1 for code, _, _ in hot_results if code not in (200, 429))
+    retry_after = sorted(int(retry) for retry, _ in rejected if retry is not None)
+    results = {
+        "surge_elapsed_s": elapsed,
+        "hot_admitted": len(admitted),
+        "hot_rejected_429": len(rejected),
+        "hot_errors": errors,
+        "hot_admitted_p50_ms": percentile(admitted, 50),
+        "hot_admitted_p99_ms": percentile(admitted, 99),
+        "hot_rejected_max_ms": max((ms for _, ms in rejected), default=None),
+        "retry_after_min_s": retry_after[0] if retry_after else None,
+        "retry_after_max_s": retry_after[-1] if retry_after else None,
+        "cold_baseline_p50_ms": percentile(baseline, 50),
+        "cold_baseline_p99_ms": percentile(baseline, 99),
+        "cold_surge_p50_ms": percentile(during, 50),
+        "cold_surge_p99_ms": percentile(during, 99),
+    }
+
+    limit = f"limit {JOIN_RATE_PER_QUEUE:g}/s, burst {JOIN_BURST_PER_QUEUE:g}" if JOIN_RATE_PER_QUEUE > 0 else "no rate limit"
+    print(f"{YELLOW}Hot queue: {args.surge} joins at once ({limit}, {QUEUE_DB_SHARE} of {DB_POOL_SIZE} DB slots){ENDC}")
+    print(f"  admitted {GREEN}{len(admitted)}{ENDC}   429 {YELLOW}{len(rejected)}{ENDC}   "
+          f"errors {RED if errors else GREEN}{errors}{ENDC}")
+    if admitted:
+        print(f"  admitted p50 {results['hot_admitted_p50_ms']:.1f} ms   p99 {results['hot_admitted_p99_ms']:.1f} ms")
+    if rejected:
+        print(f"  429s answered within {results['hot_rejected_max_ms']:.1f} ms, "
+              f"Retry-After {results['retry_after_min_s']}-{results['retry_after_max_s']} s")
+    print(f"{YELLOW}Cold queues: {args.cold_queues} x {args.cold_joins} joins{ENDC}")
+    print(f"  baseline p50 {results['cold_baseline_p50_ms']:.1f} ms   p99 {results['cold_baseline_p99_ms']:.1f} ms")
+    print(f"  surge    p50 {results['cold_surge_p50_ms']:.1f} ms   p99 {results['cold_surge_p99_ms']:.1f} ms")
+    write_report(args, "surge", results)
+
+#--------------- ENCODING ---------------#
+
+def encode_payloads(items):
+    """Prisma models shaped like the list routes' results; no database needed."""
+    now = datetime.now(timezone.utc)
+    queues = [
+        models.Queue(id=str(uuid4()), title=f"Queue {i}", businessId=str(uuid4()),
+                     createdAt=now + timedelta(seconds=i), lastTicket=i, closedAt=None)
+        for i in range(items)
+    ]
+    users = [
+        models.User(id=i, clerkUserId=f"user_{i}", name=f"User {i}", email=f"user{i}@test.com", role="customer")
+        for i in range(items)
+    ]
+    return {
+        "queues": (lambda: {"queues": queues}, lambda: {"queues": [queue_json(q) for q in queues]}),
+        "users": (lambda: {"users": users}, lambda: {"users": [user_json(u) for u in users]}),
+    }
+
+def time_encoding(encode, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        body = encode()
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return statistics.median(timings), timings[-1], len(body)
+
+def run_encode(args):
+    results = {}
+    print(f"{YELLOW}{'payload':<10}{'encoder':<28}{'p50 ms':>10}{'max ms':>10}{'bytes':>12}{ENDC}")
+    for name, (raw, typed) in encode_payloads(args.items).items():
+        # Before: models straight to FastAPI's generic encoder, then the stdlib JSONResponse
+        before = time_encoding(lambda: json.dumps(jsonable_encoder(raw())).encode(), args.repeat)
+        # After: explicit serializers straight to orjson, as the routes do now
+        after = time_encoding(lambda: FastJSONResponse(typed()).body, args.repeat)
+        results[name] = {
+            "items": args.items,
+            "jsonable_encoder_p50_ms": before[0],
+            "orjson_typed_p50_ms": after[0],
+            "speedup": before[0] / after[0],
+        }
+        for label, (p50, worst, size) in (("jsonable_encoder + json", before), ("serializers + orjson", after)):
+            print(f"{name:<10}{label:<28}{p50:>10.2f}{worst:>10.2f}{size:>12}")
+        print(f"{name:<10}{GREEN}{f'{before[0] / after[0]:.1f}x faster':<28}{ENDC}")
+    write_report(args, "encode", results)
+
+#--------------- COLD START ---------------#
+
+async def wait_for_status(client, url, deadline):
+    while time.perf_counter() < deadline:
+        try:
+            if (await client.get(url)).status_code == 200:
+                return True
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.01)
+    return False
+
+async def cold_start_once(args, warmup):
+    """Start a fresh uvicorn worker and time it from spawn to serving its first DB-bound requests."""
+    env = {**os.environ, "STARTUP_WARMUP": "1" if warmup else "0"}
+    spawned = time.perf_counter()
+    worker = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(args.port), "--log-level", "warning"],
+        env=env,
+    )
+    base = f"http://127.0.0.1:{args.port}"
+    try:
+        async with httpx.AsyncClient(base_url=base, timeout=30.0) as client:
+            if not await wait_for_status(client, "/readyz", spawned + args.timeout):
+                raise SystemExit(f"worker did not become ready within {args.timeout}s")
+            ready = time.perf_counter()
+
+            # Unknown user ids miss every cache, so each request costs a real query
+            async def first_request(i):
+                start = time.perf_counter()
+                await client.get(f"/admin/users/{-1 - i}")
+                return (time.perf_counter() - start) * 1000
+
+            latencies = sorted(await asyncio.gather(*(first_request(i) for i in range(args.burst))))
+            first_response = time.perf_counter()
+    finally:
+        worker.terminate()
+        worker.wait()
+    return {
+        "time_to_ready_ms": (ready - spawned) * 1000,
+        "time_to_first_burst_ms": (first_response - spawned) * 1000,
+        "burst_p50_ms": percentile(latencies, 50),
+        "burst_p99_ms": percentile(latencies, 99),
+    }
+
+async def run_coldstart(args):
+    results = {}
+    print(f"{YELLOW}{'warm-up':<10}{'ready ms':>12}{'first burst ms':>16}{'burst p50':>12}{'burst p99':>12}{ENDC}")
+    for warmup in (False, True):
+        runs = [await cold_start_once(args, warmup) for _ in range(args.runs)]
+        summary = {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+        results["warm" if warmup else "cold"] = {"runs": runs, "median": summary}
+        print(
+            f"{'on' if warmup else 'off':<10}{summary['time_to_ready_ms']:>12.0f}{summary['time_to_first_burst_ms']:>16.0f}"
+            f"{summary['burst_p50_ms']:>12.1f}{summary['burst_p99_ms']:>12.1f}"
+        )
+    write_report(args, "coldstart", results)
+
+#--------------- COMPARISON ---------------#
+
+def compare(args):
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    print(f"{YELLOW}{old.get('commit')} -> {new.get('commit')}{ENDC}")
+    old_seed = old.get("config", {}).get("seed")
+    new_seed = new.get("config", {}).get("seed")
+    if old_seed != new_seed:
+        print(f"{YELLOW}Runs used different seeds ({old_seed} vs {new_seed}); rerun with --seed for a like-for-like comparison{ENDC}")
+    print(f"{YELLOW}{'route':<26}{'p50 ms':>18}{'p99 ms':>18}{'rps':>16}{'db/req':>14}{ENDC}")
+    if "routes" not in old or "routes" not in new:
+        raise SystemExit("compare works on results written by 'bench.py run'")
+    for route in sorted(set(old["routes"]) | set(new["routes"])):
+        a = old["routes"].get(route)
+        b = new["routes"].get(route)
+        if a is None or b is None:
+            print(f"{route:<26} only in {'new' if a is None else 'old'} results")
+            continue
+        cells = []
+        for key, width, lower_is_better in (("p50_ms", 18, True), ("p99_ms", 18, True), ("throughput_rps", 16, False), ("mean_db_queries", 14, True)):
+            if a[key] is None or b[key] is None:
+                cells.append(f"{'-':>{width}}")
+                continue
+            change = (b[key] - a[key]) / a[key] * 100 if a[key] else 0.0
+            worse = change > args.threshold if lower_is_better else change < -args.threshold
+            color = RED if worse else GREEN
+            cells.append(f"{color}{f'{b[key]:.1f} ({change:+.0f}%)':>{width}}{ENDC}")
+        print(f"{route:<26}{''.join(cells)}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = sub.add_parser("run", help="seed data and run the mixed workload")
+    run_parser.add_argument("--businesses", type=int, default=5)
+    run_parser.add_argument("--queues", type=int, default=4, help="queues per business")
+    run_parser.add_argument("--entries", type=int, default=10000, help="entries in the hot queue")
+    run_parser.add_argument("--joiners", type=int, default=5000, help="extra users available to join")
+    run_parser.add_argument("--concurrency", type=int, default=50)
+    run_parser.add_argument("--duration", type=float, default=30.0, help="seconds")
+    run_parser.add_argument("--seed", type=int, help="random seed for data and workload (default: a fresh one, recorded in the report)")
+    run_parser.add_argument("--out", default="bench_results.json")
+    run_parser.set_defaults(func=lambda a: asyncio.run(run(a)))
+
+    dispatch_parser = sub.add_parser("dispatch", help="measure call-next throughput as desks are added")
+    dispatch_parser.add_argument("--waiting", type=int, default=5000, help="people waiting in the queue")
+    dispatch_parser.add_argument("--desks", default="1,2,4,8,16", help="comma-separated desk counts")
+    dispatch_parser.add_argument("--out", default="bench_results_dispatch.json")
+    dispatch_parser.set_defaults(func=lambda a: asyncio.run(run_dispatch(a)))
+
+    surge_parser = sub.add_parser("surge", help="flood one queue with joins and watch the others")
+    surge_parser.add_argument("--surge", type=int, default=1000, help="simultaneous joins on the hot queue")
+    surge_parser.add_argument("--cold-queues", type=int, default=10)
+    surge_parser.add_argument("--cold-joins", type=int, default=5, help="sequential joins per cold queue")
+    surge_parser.add_argument("--out", default="bench_results_surge.json")
+    surge_parser.set_defaults(func=lambda a: asyncio.run(run_surge(a)))
+
+    encode_parser = sub.add_parser("encode", help="time JSON encoding of large list payloads")
+    encode_parser.add_argument("--items", type=int, default=10000, help="models per payload")
+    encode_parser.add_argument("--repeat", type=int, default=20)
+    encode_parser.add_argument("--out", default="bench_results_encode.json")
+    encode_parser.set_defaults(func=run_encode)
+
+    coldstart_parser = sub.add_parser("coldstart", help="time fresh workers from spawn to first requests, with and without warm-up")
+    coldstart_parser.add_argument("--runs", type=int, default=5, help="worker starts per mode")
+    coldstart_parser.add_argument("--burst", type=int, default=50, help="concurrent requests sent once the worker is ready")
+    coldstart_parser.add_argument("--port", type=int, default=8799)
+    coldstart_parser.add_argument("--timeout", type=float, default=60.0, help="seconds to wait for readiness")
+    coldstart_parser.add_argument("--out", default="bench_results_coldstart.json")
+    coldstart_parser.set_defaults(func=lambda a: asyncio.run(run_coldstart(a)))
+
+    compare_parser = sub.add_parser("compare", help="compare two results files")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--threshold", type=float, default=10.0, help="percent change flagged as a regression")
+    compare_parser.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""Compare auth latency of the Clerk verification modes against a local stub.
+
+The stub answers the same endpoints as api.clerk.dev with a configurable delay,
+so the numbers show how much each mode depends on Clerk being fast.
+
+    python bench_auth.py [requests] [stub_latency_ms]
+"""
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+import httpx
+import uvicorn
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from fastapi import FastAPI, HTTPException
+from jose import jwk, jwt
+from starlette.requests import Request
+
+STUB_PORT = 8765
+REQUESTS = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+STUB_LATENCY = (float(sys.argv[2]) if len(sys.argv) > 2 else 20.0) / 1000
+
+os.environ["CLERK_API_URL"] = f"http://127.0.0.1:{STUB_PORT}"
+os.environ["CLERK_SECRET_KEY"] = "sk_test_bench"
+os.environ.pop("CLERK_JWT_PUBLIC_KEY", None)
+
+import main  # noqa: E402  (reads the Clerk settings above at import time)
+
+GREEN = "\033[92m"
+YELLOW = "\033[93m"
+ENDC = "\033[0m"
+
+private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+private_pem = private_key.private_bytes(
+    serialization.Encoding.PEM,
+    serialization.PrivateFormat.PKCS8,
+    serialization.NoEncryption(),
+).decode()
+public_pem = private_key.public_key().public_bytes(
+    serialization.Encoding.PEM,
+    serialization.PublicFormat.SubjectPublicKeyInfo,
+).decode()
+public_jwk = {**jwk.construct(public_pem, "RS256").to_dict(), "kid": "bench", "use": "sig"}
+
+CLERK_USER = {
+    "id": "user_bench",
+    "first_name": "Bench",
+    "last_name": "User",
+    "email_addresses": [{"email_address": "bench@test.com"}],
+}
+SESSION_ID = "sess_bench"
+SESSION_JWT = jwt.encode(
+    {"sub": CLERK_USER["id"], "sid": SESSION_ID, "iat": int(time.time()), "exp": int(time.time()) + 3600},
+    private_pem,
+    algorithm="RS256",
+    headers={"kid": "bench"},
+)
+
+stub = FastAPI()
+
+@stub.get("/v1/jwks")
+async def stub_jwks():
+    await asyncio.sleep(STUB_LATENCY)
+    return {"keys": [public_jwk]}
+
+@stub.get("/v1/sessions/{session_id}")
+async def stub_session(session_id: str):
+    await asyncio.sleep(STUB_LATENCY)
+    if session_id != SESSION_ID:
+        raise HTTPException(status_code=404)
+    return {"id": SESSION_ID, "user_id": CLERK_USER["id"]}
+
+@stub.get("/v1/users/{user_id}")
+async def stub_user(user_id: str):
+    await asyncio.sleep(STUB_LATENCY)
+    return CLERK_USER
+
+async def legacy_verify(session_token: str):
+    # The pre-cache implementation: a fresh client and two Clerk calls per request
+    headers = {"Authorization": f"Bearer {main.CLERK_SECRET_KEY}"}
+    async with httpx.AsyncClient(timeout=10.0) as client:
+        session_resp = await client.get(f"{main.CLERK_API_URL}/v1/sessions/{session_token}", headers=headers)
+        user_id = session_resp.json()["user_id"]
+        user_resp = await client.get(f"{main.CLERK_API_URL}/v1/users/{user_id}", headers=headers)
+        return user_resp.json()
+
+def bearer_request(token: str) -> Request:
+    return Request({"type": "http", "headers": [(b"authorization", f"Bearer {token}".encode())]})
+
+async def measure(name, verify):
+    timings = []
+    for _ in range(REQUESTS):
+        start = time.perf_counter()
+        user = await verify()
+        timings.append((time.perf_counter() - start) * 1000)
+        assert user["id"] == CLERK_USER["id"]
+    timings.sort()
+    p50 = statistics.median(timings)
+    p95 = timings[int(len(timings) * 0.95) - 1]
+    print(f"{YELLOW}{name:<22}{ENDC} p50 {GREEN}{p50:8.3f} ms{ENDC}   p95 {p95:8.3f} ms   max {timings[-1]:8.3f} ms")
+    return p50
+
+async def main_bench():
+    server = uvicorn.Server(uvicorn.Config(stub, host="127.0.0.1", port=STUB_PORT, log_level="warning"))
+    serve_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+
+    print(f"{REQUESTS} verifications per mode, stub latency {STUB_LATENCY * 1000:.0f} ms per Clerk call\n")
+    legacy = await measure("legacy (new client)", lambda: legacy_verify(SESSION_ID))
+
+    main.clerk_profiles.clear()
+    remote = await measure("remote (pooled)", lambda: main.verify_clerk_session_remote(SESSION_ID))
+
+    main.clerk_profiles.clear()
+    local = await measure("local (JWKS + cache)", lambda: main.verify_clerk_user(bearer_request(SESSION_JWT)))
+
+    print(f"\nlocal p50 is {legacy / local:.0f}x faster than legacy, {remote / local:.0f}x faster than remote")
+
+    await main.clerk_client.aclose()
+    server.should_exit = True
+    await serve_task
+
+if __name__ == "__main__":
+    asyncio.run(main_bench())
@@ -0,0 +1,135 @@
+"""Query-plan regression check for the hot lookups.
+
+Seeds a local Postgres with the same data set as bench.py, runs EXPLAIN on the
+queries behind each route and fails if any of them plans a sequential scan of
+a hot table. Point DATABASE_URL at a scratch database before running:
+
+    python explain_check.py [--businesses 50] [--queues 20] [--entries 10000]
+"""
+import argparse
+import asyncio
+import json
+import sys
+
+from bench import seed
+from main import (
+    db,
+    DISPATCH_NEXT_SQL,
+    ENQUEUE_ALMOST_UP_SQL,
+    JOIN_QUEUE_SQL,
+    NOTIFY_POSITION,
+    ALMOST_UP_TYPE,
+    ALMOST_UP_SUBJECT,
+    ALMOST_UP_BODY,
+    WAIT_PERCENTILES_SQL,
+)
+
+GREEN = "\033[92m"
+RED = "\033[91m"
+YELLOW = "\033[93m"
+ENDC = "\033[0m"
+
+# Tables that grow with traffic; a sequential scan on any of them is a regression
+HOT_TABLES = {"QueueEntry", "QueueEntryHistory", "Queue"}
+
+# Prisma-issued statements below are written the way the query engine renders them (capture
+# them with Prisma(log_queries=True) to compare): parenthesised WHERE clauses, enum values
+# cast from text, relation filters as an IN over the related table, LIMIT/OFFSET bound as
+# parameters. Only the schema prefix ("public".) and the explicit column lists are dropped;
+# neither changes the plan.
+def status_counts_sql(table):
+    """The group_by(by=[queueId, status], where={queue: {is: {businessId}}}) analytics issues."""
+    return (
+        f'SELECT "queueId", "status", COUNT(*) AS "_count._all" FROM "{table}" '
+        'WHERE ("queueId") IN (SELECT "t1"."id" FROM "Queue" AS "t1" '
+        'WHERE ("t1"."businessId" = $1 AND "t1"."id" IS NOT NULL)) '
+        'GROUP BY "queueId", "status" OFFSET $2'
+    )
+
+def route_queries(data):
+    """(route, description, sql, params) for every query the hot routes issue."""
+    queue_id = data["hot_queue"]
+    business_id = data["businesses"][0]
+    user_id = data["waiting"][len(data["waiting"]) // 2]
+    joiner = data["joiners"][0]
+    archived_queue = data["archived"][0]
+    return [
+        ("join_queue", "ticket + insert", JOIN_QUEUE_SQL, [queue_id, joiner]),
+        ("join_queue", "almost-up check", ENQUEUE_ALMOST_UP_SQL,
+            [queue_id, NOTIFY_POSITION, ALMOST_UP_TYPE, ALMOST_UP_SUBJECT, ALMOST_UP_BODY, joiner]),
+        ("change_status_user", "almost-up sweep", ENQUEUE_ALMOST_UP_SQL,
+            [queue_id, NOTIFY_POSITION, ALMOST_UP_TYPE, ALMOST_UP_SUBJECT, ALMOST_UP_BODY, None]),
+        ("get_position", "entry lookup",
+            'SELECT * FROM "QueueEntry" WHERE "queueId" = $1 AND "userId" = $2', [queue_id, user_id]),
+        ("get_position", "live position",
+            'SELECT COUNT(*) FROM "QueueEntry" WHERE "queueId" = $1 AND "status" = \'waiting\' AND "position" < $2',
+            [queue_id, 5000]),
+        ("get_position", "eta warm-up",
+            'SELECT * FROM "QueueEntry" WHERE "queueId" = $1 AND "servedAt" IS NOT NULL ORDER BY "servedAt" DESC LIMIT 20',
+            [queue_id]),
+        ("check_status_user", "archived entry",
+            'SELECT * FROM "QueueEntryHistory" WHERE "queueId" = $1 AND "userId" = $2 ORDER BY "id" DESC LIMIT 1',
+            [archived_queue, data["users"][0]]),
+        ("change_status_user", "find entry",
+            'SELECT * FROM "QueueEntry" WHERE ("queueId" = $1 AND "userId" = $2) LIMIT $3 OFFSET $4',
+            [queue_id, user_id, 1, 0]),
+        ("change_status_user", "update entry by id",
+            'UPDATE "QueueEntry" SET "status" = CAST($1::text AS "Status"), "servedAt" = $2, "skippedAt" = $3 '
+            'WHERE ("id" = $4 AND 1=1) RETURNING *',
+            ["served", None, None, 1]),
+        ("dispatch_next", "claim head", DISPATCH_NEXT_SQL, [queue_id]),
+        ("get_all_business_queues", "queues by business",
+            'SELECT * FROM "Queue" WHERE "businessId" = $1 ORDER BY "createdAt" ASC, "id" ASC LIMIT 101', [business_id]),
+        ("get_all_users_queues", "queues joined by user",
+            'SELECT * FROM "Queue" q WHERE EXISTS (SELECT 1 FROM "QueueEntry" e WHERE e."queueId" = q."id" '
+            'AND e."userId" = $1) OR EXISTS (SELECT 1 FROM "QueueEntryHistory" h WHERE h."queueId" = q."id" '
+            'AND h."userId" = $1) ORDER BY q."createdAt" ASC, q."id" ASC LIMIT 101', [user_id]),
+        ("analytics", "status counts", status_counts_sql("QueueEntry"), [business_id, 0]),
+        ("analytics", "archived status counts", status_counts_sql("QueueEntryHistory"), [business_id, 0]),
+        ("analytics", "wait percentiles", WAIT_PERCENTILES_SQL, [business_id]),
+    ]
+
+def seq_scans(plan):
+    """Yield the relation names of every sequential scan in a JSON plan tree."""
+    if plan.get("Node Type") == "Seq Scan":
+        yield plan.get("Relation Name")
+    for child in plan.get("Plans", []):
+        yield from seq_scans(child)
+
+async def explain(sql, params):
+    rows = await db.query_raw(f"EXPLAIN (FORMAT JSON) {sql}", *params)
+    plan = rows[0]["QUERY PLAN"]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]["Plan"]
+
+async def main(args):
+    await db.connect()
+    print(f"Seeding {args.businesses} businesses x {args.queues} queues, hot queue with {args.entries} entries...")
+    data = await seed(args)
+    await db.execute_raw('ANALYZE "QueueEntry", "QueueEntryHistory", "Queue", "Notification", "User"')
+
+    failures = 0
+    for route, description, sql, params in route_queries(data):
+        plan = await explain(sql, params)
+        scans = sorted({name for name in seq_scans(plan) if name in HOT_TABLES})
+        if scans:
+            failures += 1
+            print(f"{RED}FAIL{ENDC}  {YELLOW}{route}{ENDC} {description}: sequential scan on {', '.join(scans)}")
+            if args.verbose:
+                print(json.dumps(plan, indent=2))
+        else:
+            print(f"{GREEN}PASS{ENDC}  {YELLOW}{route}{ENDC} {description}")
+
+    await db.disconnect()
+    print(f"\n{RED if failures else GREEN}{failures} hot path(s) fell back to a sequential scan{ENDC}")
+    return failures
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--businesses", type=int, default=50)
+    parser.add_argument("--queues", type=int, default=20, help="queues per business")
+    parser.add_argument("--entries", type=int, default=10000, help="entries in the hot queue")
+    parser.add_argument("--joiners", type=int, default=10)
+    parser.add_argument("--verbose", action="store_true", help="print the plan of failing queries")
+    sys.exit(1 if asyncio.run(main(parser.parse_args())) else 0)
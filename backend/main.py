@@ -1,21 +1,350 @@
-from fastapi import FastAPI, Depends, HTTPException, Path, Request, status
+from fastapi import FastAPI, Depends, HTTPException, Path, Query, Request, status
 from prisma import Prisma
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.datastructures import MutableHeaders
+from fastapi.responses import Response, StreamingResponse
 from dotenv import load_dotenv
 import os
 from jose import jwt, JWTError
 import httpx
+import asyncio
+import base64
+import binascii
+import bisect
+import contextlib
+import contextvars
+import hashlib
+import itertools
+import json
+import logging
+import math
+import time
+from typing import TypedDict
+import orjson
+from collections import OrderedDict
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
 from uuid import uuid4
 from datetime import datetime, timezone
 import smtplib
 from email.mime.text import MIMEText
 
+try:
+    import asyncpg
+except ImportError:  # Without asyncpg the change feed stays within one worker
+    asyncpg = None
+
 load_dotenv()
 
-app = FastAPI()
-db = Prisma()
+logger = logging.getLogger("qwaita")
+
+#--------------- METRICS ---------------#
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34)
+# Requests slower than this many milliseconds are logged with a per-phase breakdown; 0 disables
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "0"))
+
+# Per-request {phase: [calls, seconds]}; phases are "db", "http" and "smtp"
+current_phases = contextvars.ContextVar("current_phases", default=None)
+
+class Histogram:
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class MetricsRegistry:
+    """Counters and histograms rendered in the Prometheus text exposition format."""
+
+    def __init__(self):
+        self._histograms = {}
+        self._counters = {}
+        self._help = {}
+
+    def describe(self, name: str, help_text: str):
+        self._help[name] = help_text
+
+    def observe(self, name: str, labels: dict, value: float, buckets: tuple = LATENCY_BUCKETS):
+        series = self._histograms.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        histogram = series.get(key)
+        if histogram is None:
+            histogram = series[key] = Histogram(buckets)
+        histogram.observe(value)
+
+    def inc(self, name: str, labels: dict, amount: float = 1):
+        series = self._counters.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        series[key] = series.get(key, 0) + amount
+
+    def render(self, gauges: dict = None) -> str:
+        lines = []
+        for name, series in sorted(self._counters.items()):
+            self._header(lines, name, "counter")
+            for key, value in series.items():
+                lines.append(f"{name}{format_labels(key)} {value}")
+        for name, series in sorted(self._histograms.items()):
+            self._header(lines, name, "histogram")
+            for key, histogram in series.items():
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{format_labels(key + (('le', str(bound)),))} {cumulative}")
+                lines.append(f"{name}_sum{format_labels(key)} {histogram.sum}")
+                lines.append(f"{name}_count{format_labels(key)} {histogram.count}")
+        for name, (labels, value) in sorted((gauges or {}).items()):
+            self._header(lines, name, "gauge")
+            lines.append(f"{name}{format_labels(tuple(sorted(labels.items())))} {value}")
+        return "\n".join(lines) + "\n"
+
+    def _header(self, lines: list, name: str, kind: str):
+        if name in self._help:
+            lines.append(f"# HELP {name} {self._help[name]}")
+        lines.append(f"# TYPE {name} {kind}")
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_labels(items: tuple) -> str:
+    if not items:
+        return ""
+    return "{" + ",".join(f'{key}="{escape_label(value)}"' for key, value in items) + "}"
+
+metrics = MetricsRegistry()
+metrics.describe("qwaita_http_requests_total", "HTTP requests by route and status code.")
+metrics.describe("qwaita_http_request_duration_seconds", "HTTP request latency by route.")
+metrics.describe("qwaita_request_db_queries", "Database calls made while handling one request.")
+metrics.describe("qwaita_db_query_duration_seconds", "Latency of each Prisma call by operation.")
+metrics.describe("qwaita_external_call_duration_seconds", "Latency of outbound HTTP and SMTP calls.")
+metrics.describe("qwaita_archived_entries_total", "Queue entries moved to QueueEntryHistory.")
+metrics.describe("qwaita_change_feed_publish_failures_total", "Change feed notifications that could not be sent.")
+metrics.describe("qwaita_almost_up_failures_total", "Almost-up sweeps that failed after the change was committed.")
+metrics.describe("qwaita_admission_rejected_total", "Requests turned away with 429 by admission control.")
+
+PHASE_METRICS = {
+    "db": "qwaita_db_query_duration_seconds",
+    "http": "qwaita_external_call_duration_seconds",
+    "smtp": "qwaita_external_call_duration_seconds",
+}
+
+@contextlib.contextmanager
+def timed(phase: str, operation: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        label = "operation" if phase == "db" else "target"
+        metrics.observe(PHASE_METRICS[phase], {label: operation}, elapsed)
+        phases = current_phases.get()
+        if phases is not None:
+            totals = phases.setdefault(phase, [0, 0.0])
+            totals[0] += 1
+            totals[1] += elapsed
+
+def timed_call(phase: str, operation: str, func):
+    async def wrapper(*args, **kwargs):
+        with timed(phase, operation):
+            return await func(*args, **kwargs)
+    return wrapper
+
+class InstrumentedActions:
+    def __init__(self, actions, model: str):
+        self._actions = actions
+        self._model = model
+        self._wrapped = {}
+
+    def __getattr__(self, name):
+        wrapped = self._wrapped.get(name)
+        if wrapped is None:
+            wrapped = timed_call("db", f"{self._model}.{name}", getattr(self._actions, name))
+            self._wrapped[name] = wrapped
+        return wrapped
+
+class InstrumentedPrisma:
+    """Passes everything through to the Prisma client, timing model actions and raw queries."""
+
+    RAW_METHODS = ("query_raw", "query_first", "execute_raw")
+
+    def __init__(self, client):
+        self._client = client
+        self._wrapped = {}
+
+    def __getattr__(self, name):
+        wrapped = self._wrapped.get(name)
+        if wrapped is not None:
+            return wrapped
+        value = getattr(self._client, name)
+        if type(value).__name__.endswith("Actions"):
+            wrapped = InstrumentedActions(value, name)
+        elif name in self.RAW_METHODS:
+            wrapped = timed_call("db", name, value)
+        else:
+            return value
+        self._wrapped[name] = wrapped
+        return wrapped
+
+    @contextlib.asynccontextmanager
+    async def tx(self, *args, **kwargs):
+        async with self._client.tx(*args, **kwargs) as transaction:
+            yield InstrumentedPrisma(transaction)
+
+class TimedTransport(httpx.AsyncBaseTransport):
+    def __init__(self, target: str, **kwargs):
+        self.target = target
+        self._transport = httpx.AsyncHTTPTransport(**kwargs)
+
+    async def handle_async_request(self, request):
+        with timed("http", self.target):
+            return await self._transport.handle_async_request(request)
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+def server_timing(phases: dict, elapsed: float) -> str:
+    parts = [f'{phase};dur={seconds * 1000:.1f};desc="{calls} calls"' for phase, (calls, seconds) in phases.items()]
+    parts.append(f"total;dur={elapsed * 1000:.1f}")
+    return ", ".join(parts)
+
+class MetricsMiddleware:
+    """Records per-route latency and per-phase timings, and adds a Server-Timing header."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        # Reuse a phase dict set by an in-process caller (bench.py) so it can read the totals
+        phases = current_phases.get()
+        token = current_phases.set(phases if phases is not None else {})
+        phases = current_phases.get()
+        start = time.perf_counter()
+        response = {"status": 500, "streaming": False}
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+                headers = MutableHeaders(scope=message)
+                response["streaming"] = headers.get("content-type", "").startswith("text/event-stream")
+                headers.append("Server-Timing", server_timing(phases, time.perf_counter() - start))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        except Exception:
+            logger.exception("Unhandled error on %s %s", scope["method"], scope["path"])
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            route = scope.get("route")
+            route_path = route.path if route is not None else "unmatched"
+            labels = {"method": scope["method"], "route": route_path}
+            metrics.inc("qwaita_http_requests_total", {**labels, "status": str(response["status"])})
+            # Streams stay open for minutes and would swamp the latency histogram
+            if not response["streaming"]:
+                metrics.observe("qwaita_http_request_duration_seconds", labels, elapsed)
+            metrics.observe("qwaita_request_db_queries", labels, phases.get("db", [0])[0], COUNT_BUCKETS)
+            if SLOW_REQUEST_MS and elapsed * 1000 >= SLOW_REQUEST_MS and not response["streaming"]:
+                breakdown = ", ".join(
+                    f"{phase}={seconds * 1000:.1f}ms/{calls}" for phase, (calls, seconds) in phases.items()
+                )
+                logger.warning(
+                    "Slow request %s %s: %.1fms (%s)",
+                    scope["method"], scope["path"], elapsed * 1000, breakdown or "no external calls",
+                )
+            current_phases.reset(token)
+
+class FastJSONResponse(Response):
+    """JSON response rendered with orjson, which also handles datetimes and enums natively."""
+
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
+#--------------- DATABASE LIFESPAN ---------------#
+
+DATABASE_URL = os.getenv("DATABASE_URL")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "10"))
+STARTUP_WARMUP = os.getenv("STARTUP_WARMUP", "1") == "1"
+READY_CHECK_TIMEOUT = float(os.getenv("READY_CHECK_TIMEOUT", "2"))
+
+def pooled_database_url(url: str) -> str:
+    # Prisma takes its pool settings from the connection string; any already in DATABASE_URL win
+    parts = urlsplit(url)
+    query = dict(parse_qsl(parts.query))
+    query.setdefault("connection_limit", str(DB_POOL_SIZE))
+    query.setdefault("pool_timeout", str(DB_POOL_TIMEOUT))
+    return urlunsplit(parts._replace(query=urlencode(query)))
 
-origins = ["http://localhost:3000"]
+# Connection string options only Prisma understands; libpq-style ones such as sslmode and
+# sslrootcert mean the same to asyncpg and must reach it
+PRISMA_URL_PARAMS = {
+    "schema", "connection_limit", "pool_timeout", "pgbouncer", "connect_timeout",
+    "socket_timeout", "statement_cache_size", "sslidentity", "sslaccept",
+}
+
+def asyncpg_database_url(url: str) -> str:
+    parts = urlsplit(url)
+    query = [(k, v) for k, v in parse_qsl(parts.query) if k not in PRISMA_URL_PARAMS]
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+db = InstrumentedPrisma(
+    Prisma(datasource={"url": pooled_database_url(DATABASE_URL)}) if DATABASE_URL else Prisma()
+)
+
+# Flipped once warm-up is done and back off when shutdown starts, so the load balancer
+# stops sending traffic before connections are closed
+readiness = {"ready": False}
+
+async def warm_up():
+    """Open the connection pool and the Clerk client before the first request needs them."""
+    start = time.perf_counter()
+    # Overlapping queries make the engine open DB_POOL_SIZE connections instead of reusing one
+    await asyncio.gather(*(db.query_raw("SELECT 1 FROM pg_sleep(0.05)") for _ in range(DB_POOL_SIZE)))
+    if not CLERK_JWT_PUBLIC_KEY:
+        try:
+            await refresh_clerk_jwks()
+        except (httpx.HTTPError, HTTPException) as e:
+            # Auth refetches the keys on demand; Clerk being slow is no reason to stay down
+            logger.warning("Could not prefetch Clerk signing keys: %s", e)
+    logger.info("Warm-up finished in %.0fms", (time.perf_counter() - start) * 1000)
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    await db.connect()
+    await db.execute_raw(BACKFILL_TICKETS_SQL)
+    if STARTUP_WARMUP:
+        await warm_up()
+    feed.start()
+    outbox.start()
+    archiver.start()
+    readiness["ready"] = True
+    try:
+        yield
+    finally:
+        readiness["ready"] = False
+        await outbox.stop()
+        await archiver.stop()
+        await feed.stop()
+        await clerk_client.aclose()
+        await db.disconnect()
+
+# Routes with large bodies return FastJSONResponse themselves, which also skips FastAPI's
+# jsonable_encoder pass over the returned dict
+app = FastAPI(default_response_class=FastJSONResponse, lifespan=lifespan)
+
+# The Vite dev server runs on 5173; deployments list their own origins in CORS_ORIGINS
+origins = os.getenv("CORS_ORIGINS", "http://localhost:3000,http://localhost:5173").split(",")
 CLERK_JWT_PUBLIC_KEY = os.getenv("CLERK_JWT_PUBLIC_KEY")
 CLERK_SECRET_KEY = os.getenv("CLERK_SECRET_KEY")  # IMPORTANT: Added missing env var
 
@@ -25,68 +354,1226 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Retry-After"],
 )
+app.add_middleware(MetricsMiddleware)
+
+#--------------- CACHE UTILS ---------------#
+
+class TTLCache:
+    """Small LRU cache whose entries also expire after `ttl` seconds."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+
+    def get(self, key):
+        item = self._data.get(key)
+        if item is None:
+            return None
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
 
 #--------------- AUTH MIDDLEWARE ---------------#
 
+CLERK_API_URL = os.getenv("CLERK_API_URL", "https://api.clerk.dev")
+CLERK_JWKS_URL = os.getenv("CLERK_JWKS_URL", f"{CLERK_API_URL}/v1/jwks")
+# "local" verifies session JWTs against the cached key set, "remote" asks Clerk on every request
+CLERK_AUTH_MODE = os.getenv("CLERK_AUTH_MODE", "local")
+CLERK_JWKS_TTL = float(os.getenv("CLERK_JWKS_TTL", "3600"))
+CLERK_JWKS_MIN_REFRESH = float(os.getenv("CLERK_JWKS_MIN_REFRESH", "30"))
+CLERK_PROFILE_TTL = float(os.getenv("CLERK_PROFILE_TTL", "300"))
+CLERK_PROFILE_CACHE_SIZE = int(os.getenv("CLERK_PROFILE_CACHE_SIZE", "10000"))
+# Session JWTs live about a minute, so a few seconds of clock skew would otherwise reject fresh ones
+CLERK_JWT_LEEWAY = float(os.getenv("CLERK_JWT_LEEWAY", "5"))
+# Comma-separated origins allowed in the azp claim; empty accepts any
+CLERK_AUTHORIZED_PARTIES = [p for p in os.getenv("CLERK_AUTHORIZED_PARTIES", "").split(",") if p]
+
+# One keep-alive client for every Clerk call instead of a new TLS handshake per request
+clerk_client = httpx.AsyncClient(
+    base_url=CLERK_API_URL,
+    headers={"Authorization": f"Bearer {CLERK_SECRET_KEY}"},
+    timeout=10.0,
+    transport=TimedTransport(
+        "clerk", limits=httpx.Limits(max_connections=100, max_keepalive_connections=20)
+    ),
+)
+clerk_profiles = TTLCache(maxsize=CLERK_PROFILE_CACHE_SIZE, ttl=CLERK_PROFILE_TTL)
+clerk_jwks = {"keys": {}, "fetched_at": 0.0}
+clerk_jwks_lock = asyncio.Lock()
+
+async def refresh_clerk_jwks():
+    resp = await clerk_client.get(CLERK_JWKS_URL)
+    if resp.status_code != 200:
+        raise HTTPException(status_code=503, detail="Could not fetch Clerk signing keys")
+    clerk_jwks["keys"] = {key.get("kid"): key for key in resp.json().get("keys", [])}
+    clerk_jwks["fetched_at"] = time.monotonic()
+
+async def get_clerk_signing_key(kid: str):
+    if CLERK_JWT_PUBLIC_KEY:
+        return CLERK_JWT_PUBLIC_KEY.replace("\\n", "\n")
+
+    key = clerk_jwks["keys"].get(kid)
+    if key and time.monotonic() - clerk_jwks["fetched_at"] < CLERK_JWKS_TTL:
+        return key
+
+    async with clerk_jwks_lock:
+        # Another request may have refreshed the key set while we waited for the lock
+        age = time.monotonic() - clerk_jwks["fetched_at"]
+        key = clerk_jwks["keys"].get(kid)
+        if key and age < CLERK_JWKS_TTL:
+            return key
+        # Unknown kids only trigger a refetch every CLERK_JWKS_MIN_REFRESH seconds
+        if age >= CLERK_JWKS_TTL or (not key and age >= CLERK_JWKS_MIN_REFRESH):
+            try:
+                await refresh_clerk_jwks()
+            except (httpx.HTTPError, HTTPException):
+                # Keep serving with the stale key set while Clerk is unreachable
+                if not clerk_jwks["keys"]:
+                    raise HTTPException(status_code=503, detail="Could not fetch Clerk signing keys")
+        return clerk_jwks["keys"].get(kid)
+
+async def get_clerk_profile(user_id: str):
+    profile = clerk_profiles.get(user_id)
+    if profile is not None:
+        return profile
+    user_resp = await clerk_client.get(f"/v1/users/{user_id}")
+    if user_resp.status_code != 200:
+        raise HTTPException(status_code=401, detail="User fetch failed")
+    profile = user_resp.json()
+    clerk_profiles.set(user_id, profile)
+    return profile
+
+async def verify_clerk_session_remote(session_token: str):
+    session_resp = await clerk_client.get(f"/v1/sessions/{session_token}")
+    if session_resp.status_code != 200:
+        raise HTTPException(status_code=401, detail="Invalid session")
+
+    session_data = session_resp.json()
+    user_id = session_data.get("user_id")
+    if not user_id:
+        raise HTTPException(status_code=401, detail="No user_id found")
+    return await get_clerk_profile(user_id)
+
+async def verify_clerk_session_local(session_token: str):
+    try:
+        header = jwt.get_unverified_header(session_token)
+    except JWTError:
+        raise HTTPException(status_code=401, detail="Invalid session")
+
+    key = await get_clerk_signing_key(header.get("kid"))
+    if not key:
+        raise HTTPException(status_code=401, detail="Invalid session")
+    try:
+        claims = jwt.decode(
+            session_token, key, algorithms=["RS256"], options={"verify_aud": False, "leeway": CLERK_JWT_LEEWAY}
+        )
+    except JWTError:
+        raise HTTPException(status_code=401, detail="Invalid session")
+    azp = claims.get("azp")
+    if CLERK_AUTHORIZED_PARTIES and azp and azp not in CLERK_AUTHORIZED_PARTIES:
+        raise HTTPException(status_code=401, detail="Invalid session")
+
+    user_id = claims.get("sub")
+    if not user_id:
+        raise HTTPException(status_code=401, detail="No user_id found")
+    return await get_clerk_profile(user_id)
+
 async def verify_clerk_user(request: Request):
     auth_header = request.headers.get("Authorization")
     if not auth_header or not auth_header.startswith("Bearer "):
         raise HTTPException(status_code=401, detail="Missing Authorization header")
 
     session_token = auth_header.split("Bearer ")[1]
-    headers = {"Authorization": f"Bearer {CLERK_SECRET_KEY}"}
+    if CLERK_AUTH_MODE == "remote":
+        return await verify_clerk_session_remote(session_token)
+    return await verify_clerk_session_local(session_token)
+
+#--------------- EMAIL UTILS ---------------#
+
+SMTP_SERVER = os.getenv("SMTP_SERVER", "smtp.gmail.com")
+SMTP_PORT = int(os.getenv("SMTP_PORT", "587"))
+SMTP_STARTTLS = os.getenv("SMTP_STARTTLS", "1") == "1"
+SMTP_IDLE_SECONDS = float(os.getenv("SMTP_IDLE_SECONDS", "60"))
+EMAIL_ADDRESS = os.getenv("EMAIL_ADDRESS", "yuvanesh.ykv@gmail.com")
+EMAIL_PASSWORD = os.getenv("EMAIL_PASSWORD")
+
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "50"))
+OUTBOX_POLL_SECONDS = float(os.getenv("OUTBOX_POLL_SECONDS", "5"))
+OUTBOX_LEASE_SECONDS = int(os.getenv("OUTBOX_LEASE_SECONDS", "120"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_BACKOFF_SECONDS = float(os.getenv("OUTBOX_BACKOFF_SECONDS", "10"))
+OUTBOX_MAX_BACKOFF_SECONDS = float(os.getenv("OUTBOX_MAX_BACKOFF_SECONDS", "3600"))
+
+class SMTPMailer:
+    """Blocking SMTP sender that keeps one authenticated connection open between batches."""
+
+    def __init__(self, host: str, port: int, username: str = None, password: str = None, starttls: bool = True):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self._server = None
+        self._last_used = 0.0
+
+    def _connect(self):
+        server = smtplib.SMTP(self.host, self.port, timeout=30)
+        if self.starttls:
+            server.starttls()
+        if self.password:
+            server.login(self.username, self.password)
+        self._server = server
+
+    def close(self):
+        if self._server is None:
+            return
+        try:
+            self._server.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+        self._server = None
 
-    async with httpx.AsyncClient(timeout=10.0) as client:
-        session_resp = await client.get(
-            f"https://api.clerk.dev/v1/sessions/{session_token}",
-            headers=headers
+    def _send(self, msg):
+        if self._server is None:
+            self._connect()
+        try:
+            self._server.send_message(msg)
+        except smtplib.SMTPServerDisconnected:
+            # The server dropped our idle connection; reconnect once and retry
+            self._connect()
+            self._server.send_message(msg)
+
+    def send_batch(self, messages: list) -> list:
+        """Send (id, MIMEText) pairs and return (id, error) pairs, error being None on success."""
+        if self._server is not None and time.monotonic() - self._last_used > SMTP_IDLE_SECONDS:
+            self.close()
+        results = []
+        for message_id, msg in messages:
+            try:
+                self._send(msg)
+                results.append((message_id, None))
+            except (smtplib.SMTPException, OSError) as e:
+                self.close()
+                results.append((message_id, e))
+        self._last_used = time.monotonic()
+        return results
+
+# Claims a batch by pushing its nextAttemptAt out by a lease, so several workers can drain
+# the outbox without sending the same message twice.
+CLAIM_OUTBOX_SQL = """
+UPDATE "Notification" n SET "nextAttemptAt" = NOW() + $2 * INTERVAL '1 second'
+FROM "User" u
+WHERE u."id" = n."sentTo" AND n."id" IN (
+    SELECT "id" FROM "Notification"
+    WHERE "sentAt" IS NULL AND "subject" IS NOT NULL AND "nextAttemptAt" <= NOW() AND "attempts" < $3
+    ORDER BY "nextAttemptAt"
+    LIMIT $1
+    FOR UPDATE SKIP LOCKED
+)
+RETURNING n."id", n."subject", n."body", n."attempts", u."email"
+"""
+
+class EmailOutbox:
+    """Background worker that delivers Notification rows through a shared SMTPMailer."""
+
+    def __init__(self, mailer: SMTPMailer):
+        self.mailer = mailer
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await asyncio.to_thread(self.mailer.close)
+
+    def wake(self):
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            try:
+                if await self.flush():
+                    continue
+            except Exception as e:
+                logger.exception("Email outbox failed: %s", e)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), OUTBOX_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def flush(self) -> int:
+        rows = await db.query_raw(CLAIM_OUTBOX_SQL, OUTBOX_BATCH_SIZE, OUTBOX_LEASE_SECONDS, OUTBOX_MAX_ATTEMPTS)
+        if not rows:
+            return 0
+
+        messages = []
+        for row in rows:
+            msg = MIMEText(row["body"] or "")
+            msg["Subject"] = row["subject"]
+            msg["From"] = EMAIL_ADDRESS
+            msg["To"] = row["email"]
+            messages.append((row["id"], msg))
+        with timed("smtp", "smtp"):
+            results = await asyncio.to_thread(self.mailer.send_batch, messages)
+
+        now = datetime.now(timezone.utc)
+        sent_ids = [message_id for message_id, error in results if error is None]
+        if sent_ids:
+            await db.notification.update_many(where={"id": {"in": sent_ids}}, data={"sentAt": now})
+
+        attempts = {row["id"]: row["attempts"] for row in rows}
+        for message_id, error in results:
+            if error is None:
+                continue
+            logger.error("Email to notification %s failed: %s", message_id, error)
+            backoff = min(OUTBOX_BACKOFF_SECONDS * 2 ** attempts[message_id], OUTBOX_MAX_BACKOFF_SECONDS)
+            await db.notification.update(
+                where={"id": message_id},
+                data={
+                    "attempts": {"increment": 1},
+                    "nextAttemptAt": datetime.fromtimestamp(now.timestamp() + backoff, timezone.utc),
+                    "lastError": str(error)[:500],
+                },
+            )
+        return len(rows)
+
+outbox = EmailOutbox(SMTPMailer(SMTP_SERVER, SMTP_PORT, EMAIL_ADDRESS, EMAIL_PASSWORD, SMTP_STARTTLS))
+
+async def send_email(user_id: int, subject: str, body: str, type: str = "email"):
+    # Requests only write the outbox row; delivery happens on the outbox worker
+    notification = await db.notification.create(
+        data={"type": type, "sentTo": user_id, "subject": subject, "body": body}
+    )
+    outbox.wake()
+    return notification
+
+#--------------- QUEUE POSITIONS ---------------#
+
+# QueueEntry.position is a ticket number that only ever grows within a queue and is never
+# rewritten. The position shown to people is their rank among the entries still waiting,
+# so serving or removing someone touches a single row.
+
+# Tickets come from Queue.lastTicket. Bumping the counter and inserting the entry happen in
+# one statement, so concurrent joins never share a ticket and the (queueId, userId) unique
+# constraint rejects duplicate joins without a separate lookup. Closed queues take no joins,
+# and people whose entry was already archived count as having joined.
+JOIN_QUEUE_SQL = """
+WITH ticket AS (
+    UPDATE "Queue" SET "lastTicket" = "lastTicket" + 1
+    WHERE "id" = $1 AND "closedAt" IS NULL
+      AND NOT EXISTS (SELECT 1 FROM "QueueEntryHistory" h WHERE h."queueId" = $1 AND h."userId" = $2)
+    RETURNING "lastTicket"
+)
+INSERT INTO "QueueEntry" ("queueId", "userId", "position", "status")
+SELECT $1, $2, "lastTicket", 'waiting'::"Status" FROM ticket
+ON CONFLICT ("queueId", "userId") DO NOTHING
+RETURNING "id", "position"
+"""
+
+# Queues created before Queue.lastTicket existed start their counter after their highest ticket
+BACKFILL_TICKETS_SQL = """
+UPDATE "Queue" q SET "lastTicket" = (SELECT MAX(e."position") FROM "QueueEntry" e WHERE e."queueId" = q."id")
+WHERE q."lastTicket" = 0 AND EXISTS (SELECT 1 FROM "QueueEntry" e WHERE e."queueId" = q."id")
+"""
+
+async def insert_queue_entry(queue_id: str, user_id: int):
+    rows = await db.query_raw(JOIN_QUEUE_SQL, queue_id, user_id)
+    if rows:
+        return rows[0]
+    queue = await db.queue.find_unique(where={"id": queue_id})
+    if not queue:
+        raise HTTPException(status_code=404, detail="Queue not found")
+    if queue.closedAt:
+        raise HTTPException(status_code=400, detail="Queue is closed.")
+    raise HTTPException(status_code=400, detail="User already joined this queue.")
+
+async def find_queue_entry(queue_id: str, user_id: int):
+    return await db.queueentry.find_unique(
+        where={"queueId_userId": {"queueId": queue_id, "userId": user_id}}
+    )
+
+async def find_archived_entry(queue_id: str, user_id: int):
+    return await db.queueentryhistory.find_first(
+        where={"queueId": queue_id, "userId": user_id}, order={"id": "desc"}
+    )
+
+async def live_position(entry) -> int:
+    ahead = await db.queueentry.count(
+        where={"queueId": entry.queueId, "status": "waiting", "position": {"lt": entry.position}}
+    )
+    return ahead + 1
+
+#--------------- LIVE QUEUE UPDATES ---------------#
+
+STREAM_BUFFER_SIZE = int(os.getenv("STREAM_BUFFER_SIZE", "64"))
+STREAM_HEARTBEAT_SECONDS = float(os.getenv("STREAM_HEARTBEAT_SECONDS", "15"))
+# A snapshot is re-read while changes keep arriving during the read, up to this many times
+STREAM_SNAPSHOT_ATTEMPTS = int(os.getenv("STREAM_SNAPSHOT_ATTEMPTS", "5"))
+
+class QueueBroadcaster:
+    """In-process fan-out of queue change events to the streams watching each queue.
+
+    Publishing is a put_nowait per subscriber, so an idle stream costs one small
+    asyncio.Queue. A subscriber that falls STREAM_BUFFER_SIZE events behind is told
+    to resync instead of holding up the publisher.
+    """
+
+    def __init__(self, buffer_size: int = STREAM_BUFFER_SIZE):
+        self.buffer_size = buffer_size
+        self._subscribers = {}
+
+    def subscribe(self, queue_id: str) -> asyncio.Queue:
+        subscription = asyncio.Queue(maxsize=self.buffer_size)
+        self._subscribers.setdefault(queue_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, queue_id: str, subscription: asyncio.Queue):
+        subscribers = self._subscribers.get(queue_id)
+        if subscribers is None:
+            return
+        subscribers.discard(subscription)
+        if not subscribers:
+            del self._subscribers[queue_id]
+
+    def publish(self, queue_id: str, event: dict):
+        for subscription in self._subscribers.get(queue_id, ()):
+            if subscription.full():
+                while not subscription.empty():
+                    subscription.get_nowait()
+                subscription.put_nowait({"type": "resync"})
+                continue
+            subscription.put_nowait(event)
+
+    def subscriber_count(self, queue_id: str = None) -> int:
+        if queue_id is not None:
+            return len(self._subscribers.get(queue_id, ()))
+        return sum(len(s) for s in self._subscribers.values())
+
+    def queue_ids(self) -> list:
+        return list(self._subscribers)
+
+broadcaster = QueueBroadcaster()
+
+def status_change_event(entry, new_status: str):
+    # Only moving into or out of "waiting" shifts anyone's live position
+    was_waiting = entry.status == "waiting"
+    if was_waiting == (new_status == "waiting"):
+        return None
+    return {
+        "type": "returned" if new_status == "waiting" else "left",
+        "ticket": entry.position,
+        "userId": entry.userId,
+        "status": new_status,
+    }
+
+def sse_message(data: dict) -> str:
+    return f"data: {orjson.dumps(data).decode()}\n\n"
+
+#--------------- CHANGE FEED ---------------#
+
+CHANGE_FEED_ENABLED = os.getenv("CHANGE_FEED", "1") == "1"
+CHANGE_FEED_CHANNEL = os.getenv("CHANGE_FEED_CHANNEL", "qwaita_changes")
+CHANGE_FEED_BUFFER_SIZE = int(os.getenv("CHANGE_FEED_BUFFER_SIZE", "1024"))
+CHANGE_FEED_RECONNECT_SECONDS = float(os.getenv("CHANGE_FEED_RECONNECT_SECONDS", "1"))
+# NOTIFY payloads must stay under 8000 bytes; larger batches go out in several notifications
+CHANGE_FEED_MAX_PAYLOAD = 7000
+WORKER_ID = uuid4().hex[:12]
+
+NOTIFY_CHANGES_SQL = "SELECT pg_notify($1, $2)"
+
+class ChangeFeed:
+    """Queue change events shared by every worker through Postgres LISTEN/NOTIFY.
+
+    publish() hands events to this worker's streams and subscribers right away and sends
+    them to the other workers with pg_notify. Each worker keeps one asyncpg connection
+    that LISTENs and delivers incoming events the same way, skipping its own.
+
+    subscribe() is the internal API for in-process state: every change, from any worker,
+    arrives as {"queueId", "origin", "events"}. A subscriber that falls behind, or misses
+    changes while the listener reconnects, gets a single "resync" event instead.
+    """
+
+    def __init__(self):
+        self._subscribers = set()
+        self._tasks = []
+        self._connection = None
+        self.listening = asyncio.Event()
+
+    def subscribe(self) -> asyncio.Queue:
+        subscription = asyncio.Queue(maxsize=CHANGE_FEED_BUFFER_SIZE)
+        self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: asyncio.Queue):
+        self._subscribers.discard(subscription)
+
+    async def publish(self, queue_id, events: list):
+        """Share `events` about `queue_id` (None for changes not tied to a queue)."""
+        if not events:
+            return
+        self._deliver(queue_id, events, WORKER_ID)
+        if not CHANGE_FEED_ENABLED:
+            return
+        # The change is already committed; failing to tell other workers must not fail the request
+        try:
+            for payload in self._payloads(queue_id, events):
+                await db.execute_raw(NOTIFY_CHANGES_SQL, CHANGE_FEED_CHANNEL, payload)
+        except Exception as e:
+            metrics.inc("qwaita_change_feed_publish_failures_total", {})
+            logger.warning("Could not publish %d change(s) for queue %s: %s", len(events), queue_id, e)
+
+    def _payloads(self, queue_id, events: list):
+        batch = []
+        size = 0
+        for event in events:
+            encoded = len(orjson.dumps(event))
+            if batch and size + encoded > CHANGE_FEED_MAX_PAYLOAD:
+                yield orjson.dumps({"w": WORKER_ID, "q": queue_id, "e": batch}).decode()
+                batch, size = [], 0
+            batch.append(event)
+            size += encoded + 1
+        yield orjson.dumps({"w": WORKER_ID, "q": queue_id, "e": batch}).decode()
+
+    def _deliver(self, queue_id, events: list, origin: str):
+        if queue_id is not None:
+            for event in events:
+                broadcaster.publish(queue_id, event)
+        change = {"queueId": queue_id, "origin": origin, "events": events}
+        for subscription in self._subscribers:
+            if subscription.full():
+                while not subscription.empty():
+                    subscription.get_nowait()
+                subscription.put_nowait({"queueId": None, "origin": None, "events": [{"type": "resync"}]})
+                continue
+            subscription.put_nowait(change)
+
+    def _resync(self):
+        for queue_id in broadcaster.queue_ids():
+            broadcaster.publish(queue_id, {"type": "resync"})
+        self._deliver(None, [{"type": "resync"}], None)
+
+    def _on_notify(self, connection, pid, channel, payload):
+        try:
+            message = orjson.loads(payload)
+        except orjson.JSONDecodeError:
+            logger.warning("Ignoring malformed change feed payload: %.200s", payload)
+            return
+        if message.get("w") != WORKER_ID:
+            self._deliver(message.get("q"), message.get("e", []), message.get("w"))
+
+    def start(self):
+        if self._tasks:
+            return
+        self._tasks.append(asyncio.create_task(apply_remote_changes(self.subscribe())))
+        if not CHANGE_FEED_ENABLED:
+            return
+        if asyncpg is None or not DATABASE_URL:
+            logger.warning("Change feed is local to this worker: asyncpg or DATABASE_URL is missing")
+            return
+        self._tasks.append(asyncio.create_task(self._listen()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks = []
+
+    async def _listen(self):
+        # asyncpg rejects Prisma's own options but needs the TLS ones to verify the server
+        dsn = asyncpg_database_url(DATABASE_URL)
+        connected_before = False
+        while True:
+            try:
+                self._connection = await asyncpg.connect(dsn)
+                lost = asyncio.Event()
+                self._connection.add_termination_listener(lambda connection: lost.set())
+                await self._connection.add_listener(CHANGE_FEED_CHANNEL, self._on_notify)
+                self.listening.set()
+                if connected_before:
+                    # Changes made while we were disconnected are gone; consumers refetch
+                    self._resync()
+                connected_before = True
+                await lost.wait()
+                logger.warning("Change feed connection lost, reconnecting")
+            except asyncio.CancelledError:
+                if self._connection is not None:
+                    await self._connection.close()
+                raise
+            except Exception as e:
+                logger.warning("Change feed listener failed: %s", e)
+            self.listening.clear()
+            await asyncio.sleep(CHANGE_FEED_RECONNECT_SECONDS)
+
+feed = ChangeFeed()
+
+async def apply_remote_changes(subscription: asyncio.Queue):
+    """Keep this worker's caches and ETA estimates in step with changes made by other workers."""
+    while True:
+        change = await subscription.get()
+        if change["origin"] == WORKER_ID:
+            continue
+        served = 0
+        for event in change["events"]:
+            if event["type"] == "invalidate":
+                response_cache.invalidate(event["namespace"], event["ident"])
+            elif event["type"] == "resync":
+                response_cache.clear()
+            elif event.get("status") == "served":
+                served += 1
+        # Only queues this worker already estimates; the rest warm up from the database on demand
+        estimator = estimators.get(change["queueId"]) if served else None
+        if estimator is not None:
+            estimator.record_serve(time.time(), served)
+
+#--------------- POSITION NOTIFICATIONS ---------------#
+
+NOTIFY_POSITION = int(os.getenv("NOTIFY_POSITION", "5"))
+ALMOST_UP_TYPE = "almost_up"
+ALMOST_UP_SUBJECT = "Your Turn is Coming Soon!"
+ALMOST_UP_BODY = "Hi %s,\n\nYou are now position %s in queue %s. Please be ready."
+
+# Everyone within the first NOTIFY_POSITION waiting entries gets exactly one email per queue.
+# Looking at the head of the queue after each change catches people who jumped past the
+# threshold in one step. People already notified are filtered out before the INSERT, since
+# every proposed row draws a Notification id even when ON CONFLICT then drops it; the
+# (type, queueId, sentTo) unique key is only the guard against two sweeps racing.
+# $6, when set, limits the sweep to one user: a join moves nobody else up.
+ENQUEUE_ALMOST_UP_SQL = """
+INSERT INTO "Notification" ("type", "sentTo", "queueId", "subject", "body")
+SELECT $3, w."userId", $1, $4, format($5, COALESCE(u."name", ''), w."livePosition", $1)
+FROM (
+    SELECT "userId", ROW_NUMBER() OVER (ORDER BY "position") AS "livePosition"
+    FROM "QueueEntry"
+    WHERE "queueId" = $1 AND "status" = 'waiting'
+    ORDER BY "position"
+    LIMIT $2
+) w
+JOIN "User" u ON u."id" = w."userId"
+WHERE u."email" IS NOT NULL
+  AND ($6::int IS NULL OR w."userId" = $6::int)
+  AND NOT EXISTS (
+      SELECT 1 FROM "Notification" n
+      WHERE n."type" = $3 AND n."queueId" = $1 AND n."sentTo" = w."userId"
+  )
+ON CONFLICT ("type", "queueId", "sentTo") DO NOTHING
+RETURNING "id", "sentTo"
+"""
+
+async def notify_almost_up(queue_id: str, user_id: int = None) -> list:
+    """Enqueue the almost-up email for newly eligible people; returns the user ids notified.
+
+    Runs after the change that triggered it is committed, so a failure is logged and
+    counted rather than failing the request.
+    """
+    try:
+        rows = await db.query_raw(
+            ENQUEUE_ALMOST_UP_SQL,
+            queue_id, NOTIFY_POSITION, ALMOST_UP_TYPE, ALMOST_UP_SUBJECT, ALMOST_UP_BODY, user_id,
         )
-        if session_resp.status_code != 200:
-            raise HTTPException(status_code=401, detail="Invalid session")
+    except Exception as e:
+        metrics.inc("qwaita_almost_up_failures_total", {})
+        logger.warning("Could not enqueue almost-up emails for queue %s: %s", queue_id, e)
+        return []
+    if rows:
+        outbox.wake()
+    return [row["sentTo"] for row in rows]
+
+#--------------- WAIT TIME ESTIMATES ---------------#
+
+ETA_ALPHA = float(os.getenv("ETA_ALPHA", "0.2"))
+ETA_MAX_GAP_SECONDS = float(os.getenv("ETA_MAX_GAP_SECONDS", "1800"))
+ETA_WARMUP_SERVES = int(os.getenv("ETA_WARMUP_SERVES", "20"))
 
-        session_data = session_resp.json()
-        user_id = session_data.get("user_id")
-        if not user_id:
-            raise HTTPException(status_code=401, detail="No user_id found")
+class ServiceRateEstimator:
+    """EWMA of the gap between consecutive serves in one queue, updated in O(1) per serve."""
 
-        user_resp = await client.get(
-            f"https://api.clerk.dev/v1/users/{user_id}",
-            headers=headers
+    def __init__(self, alpha: float = ETA_ALPHA):
+        self.alpha = alpha
+        self.interval = None
+        self.last_served_at = None
+
+    def record_serve(self, served_at: float, count: int = 1):
+        if self.last_served_at is not None:
+            # A batch of serves spreads the gap since the previous serve across the people in it
+            gap = (served_at - self.last_served_at) / count
+            # Gaps such as a desk closing overnight say nothing about the service rate
+            if 0 <= gap <= ETA_MAX_GAP_SECONDS:
+                self.interval = gap if self.interval is None else self.alpha * gap + (1 - self.alpha) * self.interval
+        if self.last_served_at is None or served_at > self.last_served_at:
+            self.last_served_at = served_at
+
+    def eta_seconds(self, position: int, now: float):
+        if self.interval is None:
+            return None
+        return max(0.0, self.last_served_at + self.interval * position - now)
+
+estimators = TTLCache(maxsize=int(os.getenv("ETA_CACHE_SIZE", "10000")), ttl=86400)
+
+async def get_estimator(queue_id: str) -> ServiceRateEstimator:
+    estimator = estimators.get(queue_id)
+    if estimator is None:
+        # Warm up from the latest few serves after a restart instead of starting blind
+        estimator = ServiceRateEstimator()
+        recent = await db.queueentry.find_many(
+            where={"queueId": queue_id, "servedAt": {"not": None}},
+            order={"servedAt": "desc"},
+            take=ETA_WARMUP_SERVES,
         )
-        if user_resp.status_code != 200:
-            raise HTTPException(status_code=401, detail="User fetch failed")
-        return user_resp.json()
+        # Entries served by one batch share a timestamp and count as one gap, as they did live
+        for served_at, group in itertools.groupby(reversed(recent), key=lambda entry: entry.servedAt):
+            estimator.record_serve(served_at.timestamp(), len(list(group)))
+    estimators.set(queue_id, estimator)
+    return estimator
 
-#--------------- EMAIL UTILS ---------------#
+async def record_serve(queue_id: str, served_at: datetime, count: int = 1):
+    estimator = estimators.get(queue_id)
+    if estimator is None:
+        # The serve is already written, so a cold estimator warms up with it included;
+        # recording it again would add a gap of zero and pull the interval toward nothing
+        await get_estimator(queue_id)
+        return
+    estimator.record_serve(served_at.timestamp(), count)
 
-SMTP_SERVER = "smtp.gmail.com"
-SMTP_PORT = 587
-EMAIL_ADDRESS = "yuvanesh.ykv@gmail.com"
-EMAIL_PASSWORD = os.getenv("EMAIL_PASSWORD")
+def status_update_data(entry, status_val: str, now: datetime) -> dict:
+    data = {"status": status_val}
+    if entry.status != status_val:
+        data["servedAt"] = now if status_val == "served" else None
+        data["skippedAt"] = now if status_val == "skipped" else None
+    return data
+
+async def update_entry_status(entry, status_val: str, now: datetime):
+    # Only applies if nobody changed the entry since it was read, so two desks acting on the
+    # same person cannot both publish the move and shift everyone behind twice
+    updated = await db.queueentry.update_many(
+        where={"id": entry.id, "status": entry.status},
+        data=status_update_data(entry, status_val, now),
+    )
+    if updated != 1:
+        raise HTTPException(status_code=409, detail="Entry was changed by another request, please retry")
+
+#--------------- ENTRY ARCHIVE ---------------#
+
+# Served and skipped entries stay live for a grace period, so status checks, undoing a
+# serve and the ETA warm-up keep working, and are then moved to QueueEntryHistory.
+ARCHIVE_GRACE_SECONDS = float(os.getenv("ARCHIVE_GRACE_SECONDS", "3600"))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "1000"))
+ARCHIVE_INTERVAL_SECONDS = float(os.getenv("ARCHIVE_INTERVAL_SECONDS", "300"))
+
+# Moves one batch of matching rows in a single statement. SKIP LOCKED leaves rows that a
+# request is updating right now for the next pass, and lets several workers compact at once.
+ARCHIVE_ENTRIES_SQL = """
+WITH moved AS (
+    DELETE FROM "QueueEntry" WHERE "id" IN (
+        SELECT e."id" FROM "QueueEntry" e
+        {source}
+        LIMIT $2
+        FOR UPDATE OF e SKIP LOCKED
+    )
+    RETURNING "id", "userId", "queueId", "position", "status", "joinedAt", "servedAt", "skippedAt"
+)
+INSERT INTO "QueueEntryHistory" ("id", "userId", "queueId", "position", "status", "joinedAt", "servedAt", "skippedAt")
+SELECT "id", "userId", "queueId", "position", "status", "joinedAt", "servedAt", "skippedAt" FROM moved
+"""
+
+ARCHIVE_SOURCES = {
+    "finished": ARCHIVE_ENTRIES_SQL.format(source="""WHERE e."status" IN ('served'::"Status", 'skipped'::"Status")
+          AND COALESCE(e."servedAt", e."skippedAt", e."joinedAt") < NOW() - make_interval(secs => $1)"""),
+    "closed": ARCHIVE_ENTRIES_SQL.format(source="""JOIN "Queue" q ON q."id" = e."queueId"
+        WHERE q."closedAt" < NOW() - make_interval(secs => $1)"""),
+}
+
+class EntryArchiver:
+    """Background job that keeps QueueEntry down to the people who are still waiting."""
 
-async def send_email(to_email: str, subject: str, body: str):
-    msg = MIMEText(body)
-    msg["Subject"] = subject
-    msg["From"] = EMAIL_ADDRESS
-    msg["To"] = to_email
+    def __init__(self):
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.compact()
+                # The same pass keeps the idempotency table from growing without bound
+                await idempotency.purge()
+            except Exception as e:
+                logger.exception("Entry archive failed: %s", e)
+            await asyncio.sleep(ARCHIVE_INTERVAL_SECONDS)
+
+    async def compact(self, grace_seconds: float = None) -> int:
+        """Archive everything eligible, one bounded batch at a time. Returns rows moved."""
+        grace = ARCHIVE_GRACE_SECONDS if grace_seconds is None else grace_seconds
+        total = 0
+        for reason, sql in ARCHIVE_SOURCES.items():
+            while True:
+                moved = await db.execute_raw(sql, grace, ARCHIVE_BATCH_SIZE)
+                if moved:
+                    metrics.inc("qwaita_archived_entries_total", {"reason": reason}, moved)
+                    total += moved
+                if moved < ARCHIVE_BATCH_SIZE:
+                    break
+                # Short transactions with a pause in between, so live traffic gets the table back
+                await asyncio.sleep(0.05)
+        return total
+
+archiver = EntryArchiver()
+
+#--------------- ADMISSION CONTROL ---------------#
+
+# A hot queue is expected to take thousands of joins per second, so there is no per-queue
+# rate limit unless JOIN_RATE_PER_QUEUE is set; QUEUE_DB_SHARE is what keeps it fair
+JOIN_RATE_PER_QUEUE = float(os.getenv("JOIN_RATE_PER_QUEUE", "0"))
+JOIN_BURST_PER_QUEUE = float(os.getenv("JOIN_BURST_PER_QUEUE", str(max(1.0, JOIN_RATE_PER_QUEUE))))
+JOIN_RATE_PER_USER = float(os.getenv("JOIN_RATE_PER_USER", "1"))
+JOIN_BURST_PER_USER = float(os.getenv("JOIN_BURST_PER_USER", "5"))
+ADMISSION_MAX_WAIT = float(os.getenv("ADMISSION_MAX_WAIT", "2"))
+# One queue may hold most of the pool, but always leaves a quarter of it to the others
+QUEUE_DB_SHARE = int(os.getenv("QUEUE_DB_SHARE", str(max(1, DB_POOL_SIZE - DB_POOL_SIZE // 4))))
+
+def too_many_requests(detail: str, retry_after: float) -> HTTPException:
+    return HTTPException(
+        status_code=429,
+        detail=detail,
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+    )
+
+class TokenBucket:
+    """Token bucket whose balance may go negative to hold reservations for waiting callers."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+class AdmissionController:
+    """Per-queue and per-user join limits with a bounded wait before answering 429."""
+
+    def __init__(self):
+        self._queues = TTLCache(maxsize=100000, ttl=3600)
+        self._users = TTLCache(maxsize=100000, ttl=3600)
+
+    @staticmethod
+    def _bucket(buckets: TTLCache, key, rate: float, burst: float) -> TokenBucket:
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(rate, burst)
+        buckets.set(key, bucket)
+        return bucket
+
+    async def admit_join(self, queue_id: str, user_id: int):
+        now = time.monotonic()
+        buckets = [self._bucket(self._users, user_id, JOIN_RATE_PER_USER, JOIN_BURST_PER_USER)]
+        if JOIN_RATE_PER_QUEUE > 0:
+            buckets.append(self._bucket(self._queues, queue_id, JOIN_RATE_PER_QUEUE, JOIN_BURST_PER_QUEUE))
+        wait = max(bucket.wait_time(now) for bucket in buckets)
+        if wait > ADMISSION_MAX_WAIT:
+            metrics.inc("qwaita_admission_rejected_total", {"reason": "rate"})
+            raise too_many_requests("Too many joins right now, please retry shortly", wait)
+        for bucket in buckets:
+            bucket.take(now)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+class FairScheduler:
+    """Shares DB_POOL_SIZE connection slots between queues, each capped at QUEUE_DB_SHARE.
+
+    A surge on one queue queues up behind its own cap while other queues still find
+    free slots, instead of every pooled connection going to the hot queue.
+    """
+
+    def __init__(self, total: int, per_key: int):
+        self._global = asyncio.Semaphore(total)
+        self.per_key = per_key
+        self._keys = {}
+
+    @contextlib.asynccontextmanager
+    async def slot(self, key):
+        entry = self._keys.get(key)
+        if entry is None:
+            entry = self._keys[key] = [asyncio.Semaphore(self.per_key), 0]
+        entry[1] += 1
+        deadline = time.monotonic() + ADMISSION_MAX_WAIT
+        try:
+            try:
+                await asyncio.wait_for(entry[0].acquire(), ADMISSION_MAX_WAIT)
+            except asyncio.TimeoutError:
+                metrics.inc("qwaita_admission_rejected_total", {"reason": "queue_share"})
+                raise too_many_requests("This queue is busy, please retry shortly", 1)
+            try:
+                await asyncio.wait_for(self._global.acquire(), max(0.0, deadline - time.monotonic()))
+            except asyncio.TimeoutError:
+                entry[0].release()
+                metrics.inc("qwaita_admission_rejected_total", {"reason": "pool"})
+                raise too_many_requests("Server is busy, please retry shortly", 1)
+            try:
+                yield
+            finally:
+                self._global.release()
+                entry[0].release()
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._keys[key]
+
+admission = AdmissionController()
+scheduler = FairScheduler(total=DB_POOL_SIZE, per_key=QUEUE_DB_SHARE)
+
+#--------------- PAGINATION ---------------#
+
+PAGE_SIZE = int(os.getenv("PAGE_SIZE", "100"))
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", "1000"))
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", "500"))
+KEYSET_ORDER = [{"createdAt": "asc"}, {"id": "asc"}]
+
+def encode_cursor(row) -> str:
+    raw = json.dumps([row.createdAt.isoformat(), row.id]).encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+def decode_cursor(cursor: str):
     try:
-        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
-            server.starttls()
-            server.login(EMAIL_ADDRESS, EMAIL_PASSWORD)
-            server.send_message(msg)
-    except Exception as e:
-        print("Email failed:", e)
+        created_at, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        # Paged tables have string ids; anything else would reach Prisma's filter as-is
+        if not isinstance(row_id, str):
+            raise TypeError("cursor id must be a string")
+        return datetime.fromisoformat(created_at), row_id
+    except (binascii.Error, ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
 
-#--------------- DATABASE LIFESPAN ---------------#
+async def keyset_page(model, where: dict, limit: int, cursor: str = None):
+    """One page ordered by (createdAt, id) starting after `cursor`, plus the cursor of the next page."""
+    if cursor:
+        created_at, row_id = decode_cursor(cursor)
+        where = {"AND": [where, {"OR": [
+            {"createdAt": {"gt": created_at}},
+            {"createdAt": created_at, "id": {"gt": row_id}},
+        ]}]}
+    rows = await model.find_many(where=where, order=KEYSET_ORDER, take=limit + 1)
+    if len(rows) > limit:
+        return rows[:limit], encode_cursor(rows[limit - 1])
+    return rows, None
 
-@app.on_event("startup")
-async def startup():
-    await db.connect()
+def ndjson_export(model, where: dict, serialize) -> StreamingResponse:
+    # Walks the table in EXPORT_CHUNK_SIZE pages so memory stays flat for any export size
+    async def lines():
+        cursor = None
+        while True:
+            rows, cursor = await keyset_page(model, where, EXPORT_CHUNK_SIZE, cursor)
+            for row in rows:
+                yield orjson.dumps(serialize(row)) + b"\n"
+            if cursor is None:
+                return
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+def page_limit(limit: int) -> int:
+    if limit < 1 or limit > MAX_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {MAX_PAGE_SIZE}")
+    return limit
 
-@app.on_event("shutdown")
-async def shutdown():
-    await db.disconnect()
+#--------------- RESPONSE CACHE ---------------#
+
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "10000"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "60"))
+
+class ResponseCache:
+    """Encoded JSON bodies and their ETags for read routes, keyed by (namespace, id, extra).
+
+    Write routes call invalidate(namespace, id), which bumps a version that is part of
+    every key. Older entries become unreachable and age out of the LRU, and a read that
+    was already in flight during the write cannot store its stale result under the new
+    version.
+
+    The trade-off is that _versions is never pruned: it grows by one entry for every id
+    ever invalidated, so only invalidate ids a read may already have cached.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self._entries = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._versions = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def version(self, namespace: str, ident) -> int:
+        return self._versions.get((namespace, ident), 0)
+
+    def get(self, namespace: str, ident, extra=(), version: int = None):
+        if version is None:
+            version = self.version(namespace, ident)
+        entry = self._entries.get((namespace, ident, version, extra))
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def set(self, namespace: str, ident, extra, version: int, entry):
+        self._entries.set((namespace, ident, version, extra), entry)
+
+    def invalidate(self, namespace: str, ident):
+        self._versions[(namespace, ident)] = self.version(namespace, ident) + 1
+        self.invalidations += 1
+
+    def clear(self):
+        self._entries.clear()
+        self.invalidations += 1
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+            "size": len(self._entries),
+        }
+
+response_cache = ResponseCache(maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL)
+
+async def invalidate_cached(*keys):
+    """Invalidate (namespace, id) pairs in this worker's response cache and in every other worker's."""
+    for namespace, ident in keys:
+        response_cache.invalidate(namespace, ident)
+    await feed.publish(None, [{"type": "invalidate", "namespace": namespace, "ident": ident} for namespace, ident in keys])
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates or f"W/{etag}" in candidates
+
+async def cached_json(request: Request, namespace: str, ident, loader, extra=()) -> Response:
+    """Serve `await loader()` from the response cache, answering If-None-Match with 304."""
+    version = response_cache.version(namespace, ident)
+    entry = response_cache.get(namespace, ident, extra, version)
+    if entry is None:
+        # HTTPExceptions raised by the loader pass through and are never cached
+        body = orjson.dumps(await loader(), option=orjson.OPT_NON_STR_KEYS)
+        entry = (body, '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"')
+        response_cache.set(namespace, ident, extra, version, entry)
+
+    body, etag = entry
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+#--------------- SERIALIZERS ---------------#
+
+# Response shapes are spelled out field by field instead of handing Prisma models to
+# the generic encoder, which is both slower and leaks every column it finds.
+
+class UserOut(TypedDict):
+    id: int
+    clerkUserId: str
+    name: str | None
+    email: str | None
+    role: str
+
+class BusinessOut(TypedDict):
+    id: str
+    name: str
+    ownerId: int
+
+class QueueOut(TypedDict):
+    id: str
+    title: str
+    businessId: str
+    createdAt: datetime
+    closedAt: datetime | None
+
+def user_json(user) -> UserOut:
+    return {
+        "id": user.id,
+        "clerkUserId": user.clerkUserId,
+        "name": user.name,
+        "email": user.email,
+        "role": user.role,
+    }
+
+def business_json(business) -> BusinessOut:
+    return {"id": business.id, "name": business.name, "ownerId": business.ownerId}
+
+def queue_json(queue) -> QueueOut:
+    # lastTicket moves on every join, so it stays out of responses that are cached
+    return {
+        "id": queue.id,
+        "title": queue.title,
+        "businessId": queue.businessId,
+        "createdAt": queue.createdAt,
+        "closedAt": queue.closedAt,
+    }
+
+#--------------- IDEMPOTENCY ---------------#
+
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", "10000"))
+IDEMPOTENCY_TTL = float(os.getenv("IDEMPOTENCY_TTL", "86400"))
+# A claim whose request never finished (the worker died) can be taken over after this long
+IDEMPOTENCY_LOCK_SECONDS = float(os.getenv("IDEMPOTENCY_LOCK_SECONDS", "30"))
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+
+# Claims a key for the calling request. An existing row is only taken over once it has
+# expired, or if it is an unfinished claim older than the lock timeout.
+CLAIM_IDEMPOTENCY_SQL = """
+INSERT INTO "IdempotencyKey" ("key", "requestHash", "createdAt")
+VALUES ($1, $2, NOW())
+ON CONFLICT ("key") DO UPDATE
+SET "requestHash" = EXCLUDED."requestHash", "statusCode" = NULL, "body" = NULL, "createdAt" = NOW()
+WHERE "IdempotencyKey"."createdAt" < NOW() - make_interval(secs => $3)
+   OR ("IdempotencyKey"."statusCode" IS NULL AND "IdempotencyKey"."createdAt" < NOW() - make_interval(secs => $4))
+RETURNING "key"
+"""
+
+PURGE_IDEMPOTENCY_SQL = """
+DELETE FROM "IdempotencyKey" WHERE "createdAt" < NOW() - make_interval(secs => $1)
+"""
+
+class IdempotencyStore:
+    """Stored 2xx responses by scoped Idempotency-Key: an in-memory LRU in front of the
+    IdempotencyKey table, which also serves as the in-flight lock across workers."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self._responses = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._inflight = set()
+
+    def remembered(self, scope: str):
+        """(requestHash, statusCode, body) of a request this worker finished, or None."""
+        return self._responses.get(scope)
+
+    async def lookup(self, scope: str):
+        """Like remembered(), falling back to requests finished by any worker."""
+        stored = self._responses.get(scope)
+        if stored is None:
+            row = await db.idempotencykey.find_unique(where={"key": scope})
+            if row and row.statusCode is not None:
+                stored = (row.requestHash, row.statusCode, row.body.encode())
+                self._responses.set(scope, stored)
+        return stored
+
+    def in_flight(self, scope: str) -> bool:
+        return scope in self._inflight
+
+    async def claim(self, scope: str, request_hash: str) -> bool:
+        rows = await db.query_raw(CLAIM_IDEMPOTENCY_SQL, scope, request_hash, IDEMPOTENCY_TTL, IDEMPOTENCY_LOCK_SECONDS)
+        if rows:
+            self._inflight.add(scope)
+        return bool(rows)
+
+    async def complete(self, scope: str, request_hash: str, status_code: int, body: bytes):
+        self._inflight.discard(scope)
+        self._responses.set(scope, (request_hash, status_code, body))
+        await db.idempotencykey.update(
+            where={"key": scope}, data={"statusCode": status_code, "body": body.decode()}
+        )
+
+    async def release(self, scope: str):
+        # Failed requests are not stored, so the client can retry with the same key
+        self._inflight.discard(scope)
+        await db.idempotencykey.delete_many(where={"key": scope, "statusCode": None})
+
+    async def purge(self) -> int:
+        return await db.execute_raw(PURGE_IDEMPOTENCY_SQL, IDEMPOTENCY_TTL)
+
+idempotency = IdempotencyStore(maxsize=IDEMPOTENCY_CACHE_SIZE, ttl=IDEMPOTENCY_TTL)
+
+def replayed_response(stored, request_hash: str) -> Response:
+    stored_hash, status_code, body = stored
+    if stored_hash != request_hash:
+        raise HTTPException(status_code=422, detail="Idempotency-Key was already used with a different request body")
+    return Response(content=body, status_code=status_code, media_type="application/json",
+                    headers={"Idempotent-Replayed": "true"})
+
+async def idempotent(request: Request, handler) -> Response:
+    """Run `await handler()` at most once per Idempotency-Key and replay its response to retries.
+
+    Keys are scoped by method and path. Only successful responses are stored; a request
+    that raises leaves nothing behind. Without the header the handler simply runs.
+    """
+    key = request.headers.get("idempotency-key")
+    if key is None:
+        return await handler()
+    if not key or len(key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+        raise HTTPException(status_code=400, detail=f"Idempotency-Key must be 1 to {IDEMPOTENCY_KEY_MAX_LENGTH} characters")
+
+    scope = hashlib.blake2b(f"{request.method} {request.url.path} {key}".encode(), digest_size=16).hexdigest()
+    request_hash = hashlib.blake2b(await request.body(), digest_size=16).hexdigest()
+
+    stored = idempotency.remembered(scope)
+    if stored is not None:
+        return replayed_response(stored, request_hash)
+    if idempotency.in_flight(scope):
+        raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still in progress")
+    if not await idempotency.claim(scope, request_hash):
+        # Another worker holds the key, or finished it before this worker's memory saw it
+        stored = await idempotency.lookup(scope)
+        if stored is not None:
+            return replayed_response(stored, request_hash)
+        raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still in progress")
+
+    try:
+        result = await handler()
+    except BaseException:
+        await idempotency.release(scope)
+        raise
+    body = orjson.dumps(result, option=orjson.OPT_NON_STR_KEYS)
+    await idempotency.complete(scope, request_hash, 200, body)
+    return Response(content=body, media_type="application/json")
 
 #--------------- AUTH ROUTES ---------------#
 
@@ -149,87 +1636,195 @@ async def admin_login(admin_data: dict = Depends(verify_clerk_user)):
 #--------------- USER AND BUSINESS ROUTES ---------------#
 
 @app.get("/admin/users/{user_id}")
-async def get_user(user_id: int = Path(...)):
-    user = await db.user.find_unique(where={"id": user_id})
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found. Please sign in.")
-    return {"User": user}
+async def get_user(request: Request, user_id: int = Path(...)):
+    async def load():
+        user = await db.user.find_unique(where={"id": user_id})
+        if not user:
+            raise HTTPException(status_code=404, detail="User not found. Please sign in.")
+        return {"User": user_json(user)}
+    return await cached_json(request, "user", user_id, load)
 
 @app.post("/admin/{user_id}/businesses")
 async def create_business(request: Request, user_id: int = Path(...)):
-    data = await request.json()
-    business_name = data.get("name")
-    owner_id = user_id
-    created_id = str(uuid4())
+    async def handle():
+        data = await request.json()
+        business_name = data.get("name")
+        owner_id = user_id
+        created_id = str(uuid4())
 
-    await db.business.create(
-        data={
-            "id": created_id,
-            "name": business_name,
-            "ownerId": owner_id,
-        }
-    )
-    return {"message": "Created business successfully"}
+        await db.business.create(
+            data={
+                "id": created_id,
+                "name": business_name,
+                "ownerId": owner_id,
+            }
+        )
+        return {"message": "Created business successfully", "id": created_id}
+    return await idempotent(request, handle)
 
 @app.get("/admin/business/{business_id}")
-async def get_business(business_id: str = Path(...)):
-    business = await db.business.find_unique(where={"id": business_id})
-    if not business:
-        raise HTTPException(status_code=404, detail="Business not found. Go to create Business")
-    return {"business": business}
+async def get_business(request: Request, business_id: str = Path(...)):
+    async def load():
+        business = await db.business.find_unique(where={"id": business_id})
+        if not business:
+            raise HTTPException(status_code=404, detail="Business not found. Go to create Business")
+        return {"business": business_json(business)}
+    return await cached_json(request, "business", business_id, load)
 
 @app.post("/admin/{business_id}/queues")
 async def create_queues(request: Request, business_id: str = Path(...)):
-    data = await request.json()
-    queue_id = str(uuid4())
-    title = data.get("title") or data.get("Title")
-    now = datetime.now(timezone.utc)
-    await db.queue.create(
-        data={
-            "id": queue_id,
-            "title": title,
-            "businessId": business_id,
-            "createdAt": now,
-        }
-    )
-    return {"message": f"Created queue successfully for the business {business_id}"}
+    async def handle():
+        data = await request.json()
+        queue_id = str(uuid4())
+        title = data.get("title") or data.get("Title")
+        now = datetime.now(timezone.utc)
+        await db.queue.create(
+            data={
+                "id": queue_id,
+                "title": title,
+                "businessId": business_id,
+                "createdAt": now,
+            }
+        )
+        await invalidate_cached(("business_queues", business_id))
+        return {"message": f"Created queue successfully for the business {business_id}", "id": queue_id}
+    return await idempotent(request, handle)
 
 @app.post("/user/queues/{queue_id}/join/{user_id}")
-async def join_queue(queue_id: str = Path(...), user_id: int = Path(...)):
-    existing = await db.queueentry.find_first(where={"queueId": queue_id, "userId": user_id})
-    if existing:
-        raise HTTPException(status_code=400, detail="User already joined this queue.")
-    count = await db.queueentry.count(where={"queueId": queue_id})
-    position = count + 1
-    await db.queueentry.create(
-        data={
-            "queueId": queue_id,
-            "userId": user_id,
-            "position": position,
-            "status": "waiting",
-        }
-    )
-    return {"message": f"User {user_id} joined queue {queue_id}"}
+async def join_queue(request: Request, queue_id: str = Path(...), user_id: int = Path(...)):
+    # Retries with the same Idempotency-Key are answered before admission control and the DB
+    async def handle():
+        await admission.admit_join(queue_id, user_id)
+        async with scheduler.slot(queue_id):
+            entry = await insert_queue_entry(queue_id, user_id)
+            await feed.publish(queue_id, [{"type": "joined", "ticket": entry["position"], "userId": user_id}])
+            await notify_almost_up(queue_id, user_id)
+        return {"message": f"User {user_id} joined queue {queue_id}", "ticket": entry["position"]}
+    return await idempotent(request, handle)
 
 @app.get("/user/queues/{queue_id}/position/{user_id}")
 async def get_position(queue_id: str = Path(...), user_id: int = Path(...)):
-    existing = await db.queueentry.find_first(where={"queueId": queue_id, "userId": user_id})
+    existing = await find_queue_entry(queue_id, user_id)
     if not existing:
         raise HTTPException(status_code=404, detail="User has not joined this queue. Please join.")
-    return {"message": f"User {user_id}'s position in queue {queue_id} is {existing.position}"}
+    position = await live_position(existing)
+    eta = None
+    if existing.status == "waiting":
+        estimator = await get_estimator(queue_id)
+        eta = estimator.eta_seconds(position, time.time())
+    return {
+        "message": f"User {user_id}'s position in queue {queue_id} is {position}",
+        "position": position,
+        "etaSeconds": eta,
+    }
+
+@app.get("/user/queues/{queue_id}/stream/{user_id}")
+async def stream_position(queue_id: str = Path(...), user_id: int = Path(...)):
+    entry = await find_queue_entry(queue_id, user_id)
+    if not entry:
+        raise HTTPException(status_code=404, detail="User has not joined this queue. Please join.")
+
+    # Subscribe before taking the snapshot so no change can fall between the two
+    subscription = broadcaster.subscribe(queue_id)
+    ticket = entry.position
+
+    async def snapshot():
+        # Every event queued so far is already in the rows read below, so drop them; if more
+        # arrive during the read it may or may not include them, so read again
+        for _ in range(STREAM_SNAPSHOT_ATTEMPTS):
+            while not subscription.empty():
+                subscription.get_nowait()
+            current = await db.queueentry.find_unique(where={"id": entry.id})
+            if not current:
+                return None, None
+            current_position = await live_position(current)
+            if subscription.empty():
+                break
+        return current, current_position
+
+    current, position = await snapshot()
+    if not current:
+        broadcaster.unsubscribe(queue_id, subscription)
+        raise HTTPException(status_code=404, detail="User has not joined this queue. Please join.")
+    status_val = current.status
+
+    async def events():
+        nonlocal position, status_val
+        try:
+            yield sse_message({"position": position, "status": status_val, "delta": 0})
+            while status_val == "waiting":
+                try:
+                    event = await asyncio.wait_for(subscription.get(), STREAM_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+
+                if event["type"] == "resync":
+                    current, new_position = await snapshot()
+                    if not current:
+                        return
+                    status_val = current.status
+                    yield sse_message({"position": new_position, "status": status_val, "delta": new_position - position})
+                    position = new_position
+                elif event.get("userId") == user_id:
+                    status_val = event.get("status", status_val)
+                    yield sse_message({"position": position, "status": status_val, "delta": 0})
+                elif event["ticket"] < ticket and event["type"] in ("left", "returned"):
+                    delta = -1 if event["type"] == "left" else 1
+                    position += delta
+                    yield sse_message({"position": position, "status": status_val, "delta": delta})
+        finally:
+            broadcaster.unsubscribe(queue_id, subscription)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 @app.get("/admin/business/{business_id}/queues")
-async def get_all_business_queues(business_id: str = Path(...)):
-    queues = await db.queue.find_many(where={"businessId": business_id}, order={"createdAt": "asc"})
-    return {"message": f"The business {business_id} has created {len(queues)} queues", "queues": queues}
+async def get_all_business_queues(
+    request: Request,
+    business_id: str = Path(...),
+    limit: int = Query(PAGE_SIZE),
+    cursor: str = Query(None),
+    response_format: str = Query("json", alias="format"),
+):
+    where = {"businessId": business_id}
+    if response_format == "ndjson":
+        return ndjson_export(db.queue, where, queue_json)
+
+    async def load():
+        queues, next_cursor = await keyset_page(db.queue, where, page_limit(limit), cursor)
+        return {
+            "message": f"Returned {len(queues)} queues of business {business_id}",
+            "queues": [queue_json(queue) for queue in queues],
+            "nextCursor": next_cursor,
+        }
+    return await cached_json(request, "business_queues", business_id, load, extra=(limit, cursor))
 
 @app.get("/admin/users/{user_id}/queues")
-async def get_all_users_queues(user_id: int = Path(...)):
-    # Should get all QueueEntry for user_id, then join with Queue to get queue info
-    queue_entries = await db.queueentry.find_many(where={"userId": user_id})
-    queue_ids = [qe.queueId for qe in queue_entries]
-    queues = await db.queue.find_many(where={"id": {"in": queue_ids}}, order={"createdAt": "asc"}) if queue_ids else []
-    return {"message": f"The user {user_id} has joined {len(queues)} queues", "queues": queues}
+async def get_all_users_queues(
+    user_id: int = Path(...),
+    limit: int = Query(PAGE_SIZE),
+    cursor: str = Query(None),
+    response_format: str = Query("json", alias="format"),
+):
+    # A single relation filter instead of fetching entries and then their queues; archived
+    # entries count too, so queues the user was served in long ago still show up
+    where = {"OR": [
+        {"queueEntries": {"some": {"userId": user_id}}},
+        {"queueHistory": {"some": {"userId": user_id}}},
+    ]}
+    if response_format == "ndjson":
+        return ndjson_export(db.queue, where, queue_json)
+    queues, next_cursor = await keyset_page(db.queue, where, page_limit(limit), cursor)
+    return FastJSONResponse({
+        "message": f"Returned {len(queues)} queues joined by user {user_id}",
+        "queues": [queue_json(queue) for queue in queues],
+        "nextCursor": next_cursor,
+    })
+
 @app.patch("/admin/queues/{queue_id}/status/{user_id}")
 async def change_status_user(
     queue_id: str = Path(...), 
@@ -241,67 +1836,330 @@ async def change_status_user(
     valid_status = ["waiting", "served", "skipped"]
     if status_val not in valid_status:
         raise HTTPException(status_code=400, detail="Invalid status")
-    entry = await db.queueentry.find_first(where={"queueId": queue_id, "userId": user_id})
+    entry = await find_queue_entry(queue_id, user_id)
     if not entry:
         raise HTTPException(status_code=404, detail="User not in the queue")
 
-    # Perform status update
-    await db.queueentry.update(
-        where={"id": entry.id},
-        data={"status": status_val}
-    )
-
-    if status_val in ["skipped", "served"]:
-        await db.queueentry.update_many(
-            where={
-                "queueId": queue_id,
-                "position": {"gt": entry.position},
-            },
-            data={
-                "position": {"decrement": 1}
-            }
-        )
+    # Positions behind this entry follow from the status change, nothing to renumber
+    now = datetime.now(timezone.utc)
+    await update_entry_status(entry, status_val, now)
+    if status_val == "served" and entry.status != "served":
+        await record_serve(queue_id, now)
+    event = status_change_event(entry, status_val)
+    if event:
+        await feed.publish(queue_id, [event])
+        await notify_almost_up(queue_id)
 
     return {"message": f"Changed status of user {user_id} in queue {queue_id} to {status_val}"}
 
 
 @app.get("/admin/queues/{queue_id}/status/{user_id}")
 async def check_status_user(queue_id: str = Path(...), user_id: int = Path(...)):
-    user_status = await db.queueentry.find_first(where={"queueId": queue_id, "userId": user_id})
+    user_status = await find_queue_entry(queue_id, user_id) or await find_archived_entry(queue_id, user_id)
     if not user_status:
         raise HTTPException(status_code=404, detail="User not in the queue")
     return {"message": f"Status of user {user_id} in queue {queue_id} is {user_status.status}"}
 
 @app.post("/admin/queues/{queue_id}/leave/{user_id}")
 async def leave_queue(queue_id: str = Path(...), user_id: int = Path(...)):
-    user = await db.queueentry.find_first(where={"queueId": queue_id, "userId": user_id})
+    user = await find_queue_entry(queue_id, user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not in the queue")
-    position_left = user.position
-    # Mark this entry skipped
-    await db.queueentry.update(
-        where={"id": user.id},
-        data={"status": "skipped"}
-    )
-    # Decrement positions of those after
-    await db.queueentry.update_many(
-        where={"queueId": queue_id, "position": {"gt": position_left}},
-        data={"position": {"decrement": 1}}
-    )
+    # Mark this entry skipped; everyone behind moves up because live positions only count waiting entries
+    await update_entry_status(user, "skipped", datetime.now(timezone.utc))
+    event = status_change_event(user, "skipped")
+    if event:
+        await feed.publish(queue_id, [event])
+        await notify_almost_up(queue_id)
     return {"message": f"User {user_id} left the queue {queue_id}. Positions updated."}
 
+# Claims the head of the queue without waiting on rows another desk is already serving,
+# so any number of desks can call the next person concurrently and never get the same one
+DISPATCH_NEXT_SQL = """
+UPDATE "QueueEntry" SET "status" = 'served'::"Status", "servedAt" = NOW()
+WHERE "status" = 'waiting'::"Status" AND "id" = (
+    SELECT "id" FROM "QueueEntry"
+    WHERE "queueId" = $1 AND "status" = 'waiting'::"Status"
+    ORDER BY "position"
+    LIMIT 1
+    FOR UPDATE SKIP LOCKED
+)
+RETURNING "id", "userId", "position"
+"""
+
+@app.post("/admin/queues/{queue_id}/next")
+async def dispatch_next(queue_id: str = Path(...)):
+    rows = await db.query_raw(DISPATCH_NEXT_SQL, queue_id)
+    if not rows:
+        raise HTTPException(status_code=404, detail="No one is waiting in this queue")
+    served = rows[0]
+
+    await feed.publish(queue_id, [{
+        "type": "left",
+        "ticket": served["position"],
+        "userId": served["userId"],
+        "status": "served",
+    }])
+    await record_serve(queue_id, datetime.now(timezone.utc))
+    await notify_almost_up(queue_id)
+    return {
+        "message": f"Serving user {served['userId']} in queue {queue_id}",
+        "userId": served["userId"],
+        "ticket": served["position"],
+    }
+
+#--------------- BATCH ROUTES ---------------#
+
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "500"))
+
+RESERVE_TICKETS_SQL = """
+UPDATE "Queue" SET "lastTicket" = "lastTicket" + $2 WHERE "id" = $1 RETURNING "lastTicket"
+"""
+
+def batch_items(data: dict, key: str) -> list:
+    items = data.get(key)
+    if not isinstance(items, list) or not items:
+        raise HTTPException(status_code=400, detail=f"Expected a non-empty list in '{key}'")
+    if len(items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"At most {BATCH_MAX_ITEMS} items per batch")
+    return items
+
+@app.patch("/admin/queues/{queue_id}/status")
+async def change_status_users(request: Request, queue_id: str = Path(...)):
+    data = await request.json()
+    updates = batch_items(data, "updates")
+    valid_status = ["waiting", "served", "skipped"]
+
+    results = []
+    wanted = {}
+    for item in updates:
+        user_id = item.get("userId") if isinstance(item, dict) else None
+        status_val = item.get("status") if isinstance(item, dict) else None
+        result = {"userId": user_id, "status": status_val}
+        # JSON true/false are ints to isinstance, so compare the type exactly
+        if type(user_id) is not int or status_val not in valid_status:
+            result["result"] = "invalid"
+        elif user_id in wanted:
+            result["result"] = "duplicate"
+        else:
+            wanted[user_id] = status_val
+        results.append(result)
+
+    now = datetime.now(timezone.utc)
+    changed = []
+    async with db.tx() as tx:
+        entries = await tx.queueentry.find_many(
+            where={"queueId": queue_id, "userId": {"in": list(wanted)}}
+        ) if wanted else []
+        by_user = {entry.userId: entry for entry in entries}
+
+        # One update_many per target status instead of one round-trip per person
+        by_status = {}
+        for user_id, status_val in wanted.items():
+            entry = by_user.get(user_id)
+            if entry and entry.status != status_val:
+                by_status.setdefault(status_val, []).append(entry)
+        for status_val, group in by_status.items():
+            await tx.queueentry.update_many(
+                where={"id": {"in": [entry.id for entry in group]}},
+                data=status_update_data(group[0], status_val, now),
+            )
+            changed.extend((entry, status_val) for entry in group)
+
+    for result in results:
+        if "result" in result:
+            continue
+        entry = by_user.get(result["userId"])
+        if not entry:
+            result["result"] = "not_found"
+        elif entry.status == result["status"]:
+            result["result"] = "unchanged"
+        else:
+            result["result"] = "updated"
+
+    events = [
+        event for entry, status_val in sorted(changed, key=lambda c: c[0].position)
+        if (event := status_change_event(entry, status_val))
+    ]
+    served = sum(1 for _, status_val in changed if status_val == "served")
+    if served:
+        await record_serve(queue_id, now, served)
+    if events:
+        await feed.publish(queue_id, events)
+        await notify_almost_up(queue_id)
+
+    updated = sum(1 for r in results if r["result"] == "updated")
+    return FastJSONResponse({"message": f"Updated {updated} of {len(results)} entries in queue {queue_id}", "results": results})
+
+@app.post("/admin/queues/{queue_id}/join")
+async def join_queue_batch(request: Request, queue_id: str = Path(...)):
+    data = await request.json()
+    user_ids = batch_items(data, "userIds")
+
+    results = []
+    candidates = []
+    for user_id in user_ids:
+        result = {"userId": user_id}
+        if type(user_id) is not int:
+            result["result"] = "invalid"
+        elif user_id in candidates:
+            result["result"] = "duplicate"
+        else:
+            candidates.append(user_id)
+        results.append(result)
+
+    joined = {}
+    async with scheduler.slot(queue_id), db.tx() as tx:
+        queue = await tx.queue.find_unique(where={"id": queue_id})
+        if not queue:
+            raise HTTPException(status_code=404, detail="Queue not found")
+        if queue.closedAt:
+            raise HTTPException(status_code=400, detail="Queue is closed.")
+        users = await tx.user.find_many(where={"id": {"in": candidates}})
+        known_users = {user.id for user in users}
+        existing = await tx.queueentry.find_many(
+            where={"queueId": queue_id, "userId": {"in": candidates}}
+        )
+        archived = await tx.queueentryhistory.find_many(
+            where={"queueId": queue_id, "userId": {"in": candidates}}
+        )
+        already = {entry.userId for entry in existing} | {entry.userId for entry in archived}
+        new_ids = [u for u in candidates if u in known_users and u not in already]
+
+        if new_ids:
+            # Reserve a block of tickets with one counter bump, then insert them together
+            rows = await tx.query_raw(RESERVE_TICKETS_SQL, queue_id, len(new_ids))
+            first_ticket = rows[0]["lastTicket"] - len(new_ids) + 1
+            tickets = {user_id: first_ticket + i for i, user_id in enumerate(new_ids)}
+            created = await tx.queueentry.create_many(
+                data=[
+                    {"queueId": queue_id, "userId": user_id, "position": ticket, "status": "waiting"}
+                    for user_id, ticket in tickets.items()
+                ],
+                skip_duplicates=True,
+            )
+            if created == len(new_ids):
+                joined = tickets
+            else:
+                # A concurrent single join won the race for some users
+                inserted = await tx.queueentry.find_many(
+                    where={"queueId": queue_id, "position": {"in": list(tickets.values())}}
+                )
+                joined = {entry.userId: entry.position for entry in inserted}
+
+    for result in results:
+        if "result" in result:
+            continue
+        user_id = result["userId"]
+        if user_id in joined:
+            result["result"] = "joined"
+        elif user_id not in known_users:
+            result["result"] = "user_not_found"
+        else:
+            result["result"] = "already_joined"
+
+    if joined:
+        await feed.publish(queue_id, [
+            {"type": "joined", "ticket": ticket, "userId": user_id} for user_id, ticket in joined.items()
+        ])
+        await notify_almost_up(queue_id)
+
+    return FastJSONResponse({"message": f"{len(joined)} of {len(results)} users joined queue {queue_id}", "results": results})
+
 @app.get("/admin/queues/{queue_id}")
-async def get_queue(queue_id: str = Path(...)):
+async def get_queue(request: Request, queue_id: str = Path(...)):
+    async def load():
+        queue = await db.queue.find_unique(where={"id": queue_id})
+        if not queue:
+            raise HTTPException(status_code=404, detail="Queue not found")
+        return {"message": f"Queue details of {queue_id}", "queue": queue_json(queue)}
+    return await cached_json(request, "queue", queue_id, load)
+
+@app.post("/admin/queues/{queue_id}/close")
+async def close_queue(queue_id: str = Path(...)):
     queue = await db.queue.find_unique(where={"id": queue_id})
-    return {"message": f"Queue details of {queue_id} is {queue}"}
+    if not queue:
+        raise HTTPException(status_code=404, detail="Queue not found")
+    if queue.closedAt is None:
+        # Its entries, waiting or not, move to the archive once the grace period has passed
+        queue = await db.queue.update(where={"id": queue_id}, data={"closedAt": datetime.now(timezone.utc)})
+        await invalidate_cached(("queue", queue_id), ("business_queues", queue.businessId))
+    return {"message": f"Queue {queue_id} is closed", "closedAt": queue.closedAt}
+
+@app.get("/admin/cache/stats")
+async def get_cache_stats():
+    return response_cache.stats()
+
+@app.get("/healthz")
+async def healthz():
+    # Liveness: the event loop answers, nothing else is checked
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz():
+    if not readiness["ready"]:
+        return FastJSONResponse({"status": "starting"}, status_code=503)
+    try:
+        await asyncio.wait_for(db.query_raw("SELECT 1"), READY_CHECK_TIMEOUT)
+    except Exception as e:
+        return FastJSONResponse({"status": "unavailable", "detail": str(e)}, status_code=503)
+    # A worker whose change feed is down still serves requests, it just hears about other workers later
+    return {"status": "ready", "changeFeed": "listening" if feed.listening.is_set() else "local"}
+
+@app.get("/metrics")
+async def get_metrics():
+    cache = response_cache.stats()
+    gauges = {
+        "qwaita_response_cache_hits": ({}, cache["hits"]),
+        "qwaita_response_cache_misses": ({}, cache["misses"]),
+        "qwaita_response_cache_invalidations": ({}, cache["invalidations"]),
+        "qwaita_response_cache_entries": ({}, cache["size"]),
+        "qwaita_stream_subscribers": ({}, broadcaster.subscriber_count()),
+    }
+    return Response(content=metrics.render(gauges), media_type="text/plain; version=0.0.4")
+
+# Served entries live in QueueEntry for the grace period and in QueueEntryHistory after it
+WAIT_PERCENTILES_SQL = """
+WITH served AS (
+    SELECT e."queueId", e."servedAt" - e."joinedAt" AS "wait"
+    FROM "QueueEntry" e JOIN "Queue" q ON q."id" = e."queueId"
+    WHERE q."businessId" = $1 AND e."servedAt" IS NOT NULL
+    UNION ALL
+    SELECT h."queueId", h."servedAt" - h."joinedAt"
+    FROM "QueueEntryHistory" h JOIN "Queue" q ON q."id" = h."queueId"
+    WHERE q."businessId" = $1 AND h."servedAt" IS NOT NULL
+)
+SELECT "queueId",
+       percentile_cont(0.5) WITHIN GROUP (ORDER BY EXTRACT(EPOCH FROM "wait")::float8) AS "p50",
+       percentile_cont(0.9) WITHIN GROUP (ORDER BY EXTRACT(EPOCH FROM "wait")::float8) AS "p90"
+FROM served
+GROUP BY GROUPING SETS (("queueId"), ())
+"""
 
 @app.get("/admin/analytics/{business_id}")
 async def get_all_queues_analytics_under_a_business(business_id: str = Path(...)):
-    queues = await db.queue.find_many(
-        where={"businessId": business_id},
-        include={"queueEntries": True},
-        order={"createdAt": "asc"}
+    # Status counts are aggregated in Postgres, so memory stays flat however long the history is
+    queues, live_counts, archived_counts, wait_rows = await asyncio.gather(
+        db.queue.find_many(where={"businessId": business_id}, order={"createdAt": "asc"}),
+        db.queueentry.group_by(
+            by=["queueId", "status"],
+            where={"queue": {"is": {"businessId": business_id}}},
+            count=True,
+        ),
+        db.queueentryhistory.group_by(
+            by=["queueId", "status"],
+            where={"queue": {"is": {"businessId": business_id}}},
+            count=True,
+        ),
+        db.query_raw(WAIT_PERCENTILES_SQL, business_id),
     )
+    counts = {}
+    for row in live_counts + archived_counts:
+        key = (row["queueId"], row["status"])
+        counts[key] = counts.get(key, 0) + row["_count"]["_all"]
+    # The row without a queueId is the business-wide rollup from GROUPING SETS
+    waits = {row["queueId"]: row for row in wait_rows}
+    no_waits = {"p50": None, "p90": None}
 
     business_total_users = 0
     total_served = 0
@@ -310,11 +2168,10 @@ async def get_all_queues_analytics_under_a_business(business_id: str = Path(...)
     all_queue_data = []
 
     for queue in queues:
-        entries = queue.queueEntries
-        total_users = len(entries)
-        served = sum(1 for e in entries if e.status == "served")
-        skipped = sum(1 for e in entries if e.status == "skipped")
-        waiting = total_users - served - skipped
+        served = counts.get((queue.id, "served"), 0)
+        skipped = counts.get((queue.id, "skipped"), 0)
+        waiting = counts.get((queue.id, "waiting"), 0)
+        total_users = served + skipped + waiting
 
         business_total_users += total_users
         total_served += served
@@ -329,11 +2186,13 @@ async def get_all_queues_analytics_under_a_business(business_id: str = Path(...)
             "servedUsers": served,
             "skippedUsers": skipped,
             "waitingUsers": waiting,
+            "waitTimeP50Seconds": waits.get(queue.id, no_waits)["p50"],
+            "waitTimeP90Seconds": waits.get(queue.id, no_waits)["p90"],
         })
 
     average_users_per_queue = business_total_users / len(queues) if queues else 0
 
-    return {
+    return FastJSONResponse({
         "businessId": business_id,
         "totalQueues": len(queues),
         "totalUsersAcrossQueues": business_total_users,
@@ -341,23 +2200,26 @@ async def get_all_queues_analytics_under_a_business(business_id: str = Path(...)
         "totalServedUsers": total_served,
         "totalSkippedUsers": total_skipped,
         "totalWaitingUsers": total_waiting,
+        "waitTimeP50Seconds": waits.get(None, no_waits)["p50"],
+        "waitTimeP90Seconds": waits.get(None, no_waits)["p90"],
         "queues": all_queue_data
-    }
+    })
 
 @app.post("/user/queues/{queue_id}/notify/{user_id}")
 async def notify_user(queue_id: str = Path(...), user_id: int = Path(...)):
-    queue_entry = await db.queueentry.find_first(
-        where={"queueId": queue_id, "userId": user_id}
-    )
+    queue_entry = await find_queue_entry(queue_id, user_id)
     if not queue_entry:
         raise HTTPException(status_code=404, detail="User not found in the queue")
-    if queue_entry.position == 5:
+    if queue_entry.status != "waiting":
+        return {"message": f"User {user_id} is {queue_entry.status}, no notification sent."}
+    position = await live_position(queue_entry)
+    if position <= NOTIFY_POSITION:
         user = await db.user.find_unique(where={"id": user_id})
         if not user or not user.email:
             raise HTTPException(status_code=404, detail="User email not found")
-        subject = "Your Turn is Coming Soon!"
-        body = f"Hi {user.name},\n\nYou are now position 5 in queue {queue_id}. Please be ready."
-        await send_email(to_email=user.email, subject=subject, body=body)
-        return {"message": f"Email notification sent to user {user_id}"}
+        # Queue mutations already enqueue this email; this only covers entries from before that
+        if user_id in await notify_almost_up(queue_id, user_id):
+            return {"message": f"Email notification queued for user {user_id}"}
+        return {"message": f"User {user_id} was already notified, no notification sent."}
     else:
-        return {"message": f"User {user_id} is at position {queue_entry.position}, no notification sent."}
+        return {"message": f"User {user_id} is at position {position}, no notification sent."}
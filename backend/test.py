@@ -1,7 +1,13 @@
 import asyncio
+import json
+import time
 import httpx
 from httpx import ASGITransport
-from main import app, db
+from uuid import uuid4
+from jose import jwt
+import main as api
+from bench import ClerkStub
+from main import app, db, archiver, EmailOutbox, SMTPMailer, send_email
 
 GREEN = "\033[92m"
 RED = "\033[91m"
@@ -20,6 +26,345 @@ def print_result(route, method, request, response, passed, error=""):
     print(f"    ---- {status_line} ----\n")
     all_results.append((route, method, status_line, response.status_code, error, request, response.text))
 
+STRESS_USERS = 500
+STRESS_CONCURRENCY = 100
+
+async def stress_join_queue(ac, business_id):
+    # Every user joins a fresh queue twice, all at once: exactly one join per user must win
+    # and the winners must hold distinct tickets.
+    await db.user.create_many(
+        data=[
+            {"clerkUserId": f"stress_user_{i}", "name": f"Stress {i}", "email": f"stress{i}@test.com"}
+            for i in range(STRESS_USERS)
+        ],
+        skip_duplicates=True,
+    )
+    users = await db.user.find_many(where={"clerkUserId": {"startswith": "stress_user_"}})
+    queue = await db.queue.create(data={"id": str(uuid4()), "title": "StressQueue", "businessId": business_id})
+
+    semaphore = asyncio.Semaphore(STRESS_CONCURRENCY)
+
+    async def join(user_id):
+        async with semaphore:
+            return await ac.post(f"/user/queues/{queue.id}/join/{user_id}")
+
+    start = time.perf_counter()
+    responses = await asyncio.gather(*(join(u.id) for u in users for _ in range(2)))
+    elapsed = time.perf_counter() - start
+
+    entries = await db.queueentry.find_many(where={"queueId": queue.id})
+    tickets = [e.position for e in entries]
+    joined = sum(1 for r in responses if r.status_code == 200)
+    rejected = sum(1 for r in responses if r.status_code == 400)
+
+    errors = []
+    if joined != len(users) or rejected != len(users):
+        errors.append(f"expected {len(users)} joins and {len(users)} duplicates, got {joined} and {rejected}")
+    if len(entries) != len(users):
+        errors.append(f"expected {len(users)} entries, found {len(entries)}")
+    if len(set(tickets)) != len(tickets):
+        errors.append("duplicate tickets handed out")
+
+    route = f"/user/queues/{queue.id}/join/{{user_id}} x{len(responses)}"
+    summary = f"{len(responses)} joins in {elapsed:.2f}s ({len(responses) / elapsed:.0f} joins/s)"
+    print_result(route, "POST", {"concurrency": STRESS_CONCURRENCY}, responses[0], not errors, "; ".join(errors))
+    print(f"    {summary}\n")
+    return not errors
+
+BATCH_USERS = 20
+
+async def check_batch_routes(ac, business_id):
+    # Batch status and batch join must label every item, keep live positions right, refuse
+    # closed queues, and agree with single joins racing for the same users.
+    await db.user.create_many(
+        data=[
+            {"clerkUserId": f"batch_user_{i}", "name": f"Batch {i}", "email": f"batch{i}@test.com"}
+            for i in range(BATCH_USERS)
+        ],
+        skip_duplicates=True,
+    )
+    users = await db.user.find_many(
+        where={"clerkUserId": {"startswith": "batch_user_"}}, order={"id": "asc"}, take=BATCH_USERS
+    )
+    u = [user.id for user in users]
+    queue = await db.queue.create(data={"id": str(uuid4()), "title": "BatchQueue", "businessId": business_id})
+    for user_id in u[:5]:
+        await ac.post(f"/user/queues/{queue.id}/join/{user_id}")
+
+    errors = []
+    status_route = f"/admin/queues/{queue.id}/status"
+    status_body = {"updates": [
+        {"userId": u[0], "status": "served"},
+        {"userId": u[1], "status": "skipped"},
+        {"userId": u[0], "status": "served"},
+        {"userId": u[2], "status": "bogus"},
+        {"userId": u[3], "status": "waiting"},
+        {"userId": -1, "status": "served"},
+        {"userId": True, "status": "served"},
+    ]}
+    status_resp = await ac.patch(status_route, json=status_body)
+    labels = [r["result"] for r in status_resp.json().get("results", [])]
+    expected = ["updated", "updated", "duplicate", "invalid", "unchanged", "not_found", "invalid"]
+    if labels != expected:
+        errors.append(f"batch status results {labels}, expected {expected}")
+    positions = []
+    for user_id in u[2:5]:
+        resp = await ac.get(f"/user/queues/{queue.id}/position/{user_id}")
+        positions.append(resp.json().get("position"))
+    if positions != [1, 2, 3]:
+        errors.append(f"positions after batch serve {positions}, expected [1, 2, 3]")
+    print_result(status_route, "PATCH", status_body, status_resp, not errors, "; ".join(errors))
+    passed = not errors
+
+    errors = []
+    join_route = f"/admin/queues/{queue.id}/join"
+    join_body = {"userIds": [u[0], u[5], -1, u[5], "x", False]}
+    join_resp = await ac.post(join_route, json=join_body)
+    labels = [r["result"] for r in join_resp.json().get("results", [])]
+    expected = ["already_joined", "joined", "user_not_found", "duplicate", "invalid", "invalid"]
+    if labels != expected:
+        errors.append(f"batch join results {labels}, expected {expected}")
+    resp = await ac.get(f"/user/queues/{queue.id}/position/{u[5]}")
+    if resp.json().get("position") != 4:
+        errors.append(f"batch-joined user at position {resp.json().get('position')}, expected 4")
+    await ac.post(f"/admin/queues/{queue.id}/close")
+    closed_resp = await ac.post(join_route, json={"userIds": [u[6]]})
+    if closed_resp.status_code != 400:
+        errors.append(f"batch join on a closed queue returned {closed_resp.status_code}")
+    print_result(join_route, "POST", join_body, join_resp, not errors, "; ".join(errors))
+    passed = passed and not errors
+
+    # Single joins racing the batch: whichever wins, every user ends up with one ticket and
+    # exactly one of the two requests reports the join
+    errors = []
+    race_queue = await db.queue.create(data={"id": str(uuid4()), "title": "BatchRace", "businessId": business_id})
+    race_route = f"/admin/queues/{race_queue.id}/join"
+    batch_resp, *single_resps = await asyncio.gather(
+        ac.post(race_route, json={"userIds": u}),
+        *(ac.post(f"/user/queues/{race_queue.id}/join/{user_id}") for user_id in u),
+    )
+    batch_joined = {r["userId"] for r in batch_resp.json().get("results", []) if r["result"] == "joined"}
+    single_joined = {user_id for user_id, resp in zip(u, single_resps) if resp.status_code == 200}
+    entries = await db.queueentry.find_many(where={"queueId": race_queue.id})
+    if batch_joined & single_joined:
+        errors.append(f"users reported joined twice: {sorted(batch_joined & single_joined)}")
+    if batch_joined | single_joined != set(u):
+        errors.append(f"users never reported joined: {sorted(set(u) - batch_joined - single_joined)}")
+    if sorted(e.userId for e in entries) != sorted(u):
+        errors.append(f"expected one entry per user, found {len(entries)}")
+    if len({e.position for e in entries}) != len(entries):
+        errors.append("duplicate tickets handed out")
+    summary = {"batch": len(batch_joined), "single": len(single_joined)}
+    print_result(race_route + " (racing single joins)", "POST", summary, batch_resp, not errors, "; ".join(errors))
+    return passed and not errors
+
+async def check_paging(ac, business_id):
+    # Following nextCursor one queue at a time must visit every queue once and stop at None,
+    # and the ndjson export must stream the same queues.
+    route = f"/admin/business/{business_id}/queues"
+    expected = {q.id for q in await db.queue.find_many(where={"businessId": business_id})}
+    errors = []
+    seen = []
+    pages = 0
+    cursor = None
+    resp = None
+    while pages <= len(expected):
+        params = {"limit": 1, **({"cursor": cursor} if cursor else {})}
+        resp = await ac.get(route, params=params)
+        body = resp.json()
+        pages += 1
+        seen += [q["id"] for q in body.get("queues", [])]
+        cursor = body.get("nextCursor")
+        if cursor is None:
+            break
+    if cursor is not None:
+        errors.append(f"nextCursor still set after {pages} pages")
+    if pages < 2:
+        errors.append(f"expected at least two pages, got {pages}")
+    if len(seen) != len(set(seen)) or set(seen) != expected:
+        errors.append(f"pages returned {len(seen)} queues, expected {len(expected)} distinct")
+    export = await ac.get(route, params={"format": "ndjson"})
+    lines = [line for line in export.text.splitlines() if line]
+    exported = [json.loads(line)["id"] for line in lines]
+    if sorted(exported) != sorted(expected):
+        errors.append(f"ndjson export returned {len(exported)} queues, expected {len(expected)}")
+    print_result(route + "?limit=1", "GET", {"pages": pages}, resp, not errors, "; ".join(errors))
+    return not errors
+
+async def check_auth_rejections(ac):
+    # Local session verification against a stubbed Clerk: forged, expired and unknown-key tokens
+    # and a foreign azp get 401, while a token a few seconds past exp is still within the leeway.
+    saved = (api.CLERK_AUTH_MODE, api.CLERK_JWT_PUBLIC_KEY, api.CLERK_AUTHORIZED_PARTIES, api.clerk_client)
+    stub = ClerkStub()
+    stub.install()
+    api.CLERK_AUTHORIZED_PARTIES = ["http://localhost:5173"]
+    other_key = ClerkStub().private_pem
+    now = int(time.time())
+
+    def token(exp_in=3600, key=stub.private_pem, kid="bench", **claims):
+        claims = {"sub": "auth_check", "iat": now, "exp": now + exp_in, **claims}
+        return jwt.encode(claims, key, algorithm="RS256", headers={"kid": kid})
+
+    header, _, signature = token().split(".")
+    forged_payload = token(sub="someone_else").split(".")[1]
+    cases = [
+        ("valid", token(), False),
+        ("tampered payload", f"{header}.{forged_payload}.{signature}", True),
+        ("expired", token(exp_in=-60), True),
+        ("within leeway", token(exp_in=-2), False),
+        ("unknown kid", token(key=other_key, kid="rotated"), True),
+        ("foreign azp", token(azp="https://evil.example"), True),
+        ("allowed azp", token(azp="http://localhost:5173"), False),
+    ]
+    errors = []
+    resp = None
+    try:
+        for name, session_token, rejected in cases:
+            resp = await ac.post("/user/login", headers={"Authorization": f"Bearer {session_token}"})
+            if (resp.status_code == 401) != rejected:
+                errors.append(f"{name}: got {resp.status_code}, expected {'401' if rejected else 'not 401'}")
+    finally:
+        await api.clerk_client.aclose()
+        api.CLERK_AUTH_MODE, api.CLERK_JWT_PUBLIC_KEY, api.CLERK_AUTHORIZED_PARTIES, api.clerk_client = saved
+        api.clerk_jwks.update({"keys": {}, "fetched_at": 0.0})
+        api.clerk_profiles.clear()
+    print_result("/user/login (session checks)", "POST", [name for name, _, _ in cases], resp, not errors, "; ".join(errors))
+    return not errors
+
+async def check_idempotency(ac, user_id):
+    # A retried create with the same Idempotency-Key must replay the first response
+    # instead of creating a second business.
+    headers = {"Idempotency-Key": str(uuid4())}
+    route = f"/admin/{user_id}/businesses"
+    body = {"name": f"Idempotent {uuid4().hex[:8]}"}
+    first = await ac.post(route, json=body, headers=headers)
+    retry = await ac.post(route, json=body, headers=headers)
+    created = await db.business.count(where={"name": body["name"]})
+
+    errors = []
+    if first.status_code != 200 or retry.status_code != 200:
+        errors.append(f"expected 200 twice, got {first.status_code} and {retry.status_code}")
+    elif first.json()["id"] != retry.json()["id"]:
+        errors.append("retry returned a different business id")
+    if retry.headers.get("idempotent-replayed") != "true":
+        errors.append("retry was not replayed")
+    if created != 1:
+        errors.append(f"expected one business, found {created}")
+    print_result(route, "POST", {"headers": headers, "body": body, "repeat": 2}, retry, not errors, "; ".join(errors))
+    return not errors
+
+async def check_archive(ac, business_id, user_id):
+    # Serve someone, close the queue and compact with no grace period: the entry must leave
+    # the live table but still show up in status checks, the user's queues and analytics.
+    queue = await db.queue.create(data={"id": str(uuid4()), "title": "ArchiveQueue", "businessId": business_id})
+    await ac.post(f"/user/queues/{queue.id}/join/{user_id}")
+    await ac.patch(f"/admin/queues/{queue.id}/status/{user_id}", json={"status": "served"})
+    close_resp = await ac.post(f"/admin/queues/{queue.id}/close")
+    moved = await archiver.compact(grace_seconds=0)
+
+    errors = []
+    if close_resp.status_code != 200:
+        errors.append(f"close returned {close_resp.status_code}")
+    if await db.queueentry.count(where={"queueId": queue.id}):
+        errors.append("entry still in the live table")
+    if not await db.queueentryhistory.count(where={"queueId": queue.id, "userId": user_id}):
+        errors.append("entry missing from the archive")
+    status_resp = await ac.get(f"/admin/queues/{queue.id}/status/{user_id}")
+    if status_resp.status_code != 200 or "served" not in status_resp.text:
+        errors.append(f"archived status lookup returned {status_resp.status_code}")
+    rejoin_resp = await ac.post(f"/user/queues/{queue.id}/join/{user_id}")
+    if rejoin_resp.status_code != 400:
+        errors.append(f"join on a closed queue returned {rejoin_resp.status_code}")
+    listed = (await ac.get(f"/admin/users/{user_id}/queues?limit=1000")).json()["queues"]
+    if queue.id not in [q["id"] for q in listed]:
+        errors.append("archived queue missing from the user's queues")
+    analytics = (await ac.get(f"/admin/analytics/{business_id}")).json()
+    stats = next((q for q in analytics["queues"] if q["queueId"] == queue.id), None)
+    if not stats or stats["servedUsers"] != 1:
+        errors.append(f"analytics lost the archived entry: {stats}")
+
+    print_result(f"/admin/queues/{queue.id}/close", "POST", {"archived": moved}, close_resp, not errors, "; ".join(errors))
+    return not errors
+
+class StandInSMTP:
+    """Just enough of an SMTP server to accept mail from smtplib without TLS or auth."""
+
+    def __init__(self):
+        self.messages = []
+        self.connections = 0
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        writer.write(b"220 stand-in ESMTP\r\n")
+        in_data = False
+        lines = []
+        while line := await reader.readline():
+            if in_data:
+                if line == b".\r\n":
+                    self.messages.append(b"".join(lines))
+                    lines = []
+                    in_data = False
+                    writer.write(b"250 OK\r\n")
+                else:
+                    lines.append(line)
+            else:
+                command = line[:4].upper()
+                if command == b"EHLO":
+                    writer.write(b"250-stand-in\r\n250 OK\r\n")
+                elif command == b"DATA":
+                    writer.write(b"354 End data with <CR><LF>.<CR><LF>\r\n")
+                    in_data = True
+                elif command == b"QUIT":
+                    writer.write(b"221 Bye\r\n")
+                    await writer.drain()
+                    break
+                else:
+                    writer.write(b"250 OK\r\n")
+            await writer.drain()
+        writer.close()
+
+async def check_email_outbox(user_id):
+    # Queue a few emails, drain the outbox against a local stand-in server and make sure
+    # they all went out over a single SMTP connection.
+    smtp = StandInSMTP()
+    server = await asyncio.start_server(smtp.handle, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    outbox = EmailOutbox(SMTPMailer("127.0.0.1", port, starttls=False))
+
+    start = time.perf_counter()
+    created = [
+        await send_email(user_id=user_id, subject=f"Outbox test {i}", body="Hello from the outbox")
+        for i in range(3)
+    ]
+    enqueue_ms = (time.perf_counter() - start) * 1000
+    while await outbox.flush():
+        pass
+    await outbox.stop()
+    server.close()
+
+    ids = [n.id for n in created]
+    sent = await db.notification.find_many(where={"id": {"in": ids}, "sentAt": {"not": None}})
+    await db.notification.delete_many(where={"id": {"in": ids}})
+
+    errors = []
+    if len(sent) != len(ids):
+        errors.append(f"{len(ids) - len(sent)} notifications not marked sent")
+    if len(smtp.messages) < len(ids):
+        errors.append(f"stand-in server received {len(smtp.messages)} of {len(ids)} messages")
+    if smtp.connections != 1:
+        errors.append(f"expected one SMTP connection, saw {smtp.connections}")
+
+    route = f"smtp://127.0.0.1:{port}"
+    summary = f"enqueued {len(ids)} emails in {enqueue_ms:.1f} ms, delivered {len(smtp.messages)} over {smtp.connections} connection(s)"
+    status_line = f"{GREEN}PASS{ENDC}" if not errors else f"{RED}FAIL{ENDC}"
+    print(f"{YELLOW}OUTBOX {route}{ENDC}")
+    print(f"    Output:  {summary}")
+    if errors:
+        print(f"    Error:   {RED}{'; '.join(errors)}{ENDC}")
+    print(f"    ---- {status_line} ----\n")
+    all_results.append((route, "SMTP", status_line, "-", "; ".join(errors), {"emails": len(ids)}, summary))
+    return not errors
+
 async def main():
     await db.connect()
 
@@ -140,6 +485,45 @@ async def main():
             pass_count += passed
             fail_count += not passed
 
+        # --- CONCURRENT JOINS ON ONE HOT QUEUE
+        if business_id:
+            passed = await stress_join_queue(ac, business_id)
+            pass_count += passed
+            fail_count += not passed
+
+        # --- BATCH ROUTES
+        if business_id:
+            passed = await check_batch_routes(ac, business_id)
+            pass_count += passed
+            fail_count += not passed
+
+        # --- PAGED AND EXPORTED LISTINGS
+        if business_id:
+            passed = await check_paging(ac, business_id)
+            pass_count += passed
+            fail_count += not passed
+
+        # --- SESSION TOKEN REJECTIONS
+        passed = await check_auth_rejections(ac)
+        pass_count += passed
+        fail_count += not passed
+
+        # --- IDEMPOTENT RETRIES
+        passed = await check_idempotency(ac, user_id)
+        pass_count += passed
+        fail_count += not passed
+
+        # --- CLOSE AND ARCHIVE
+        if business_id:
+            passed = await check_archive(ac, business_id, user_id)
+            pass_count += passed
+            fail_count += not passed
+
+        # --- EMAIL OUTBOX
+        passed = await check_email_outbox(user_id)
+        pass_count += passed
+        fail_count += not passed
+
         get_user_queues_route = f"/admin/users/{user_id}/queues"
         resp = await ac.get(get_user_queues_route)
         passed = resp.status_code == 200
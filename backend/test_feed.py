@@ -0,0 +1,134 @@
+"""Multi-process check of the LISTEN/NOTIFY change feed.
+
+Starts two uvicorn workers against the same Postgres, changes a queue through one of
+them and checks that the other reacts without polling: its SSE stream moves the
+waiting customer up, and its cached queue details drop once the queue is closed.
+Point DATABASE_URL at a scratch database before running:
+
+    python test_feed.py
+"""
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+from uuid import uuid4
+
+import httpx
+
+from main import db
+
+GREEN = "\033[92m"
+RED = "\033[91m"
+YELLOW = "\033[93m"
+ENDC = "\033[0m"
+
+PORTS = (8811, 8812)
+EVENT_TIMEOUT = 5.0
+all_results = []
+
+def record(name, passed, detail=""):
+    status_line = f"{GREEN}PASS{ENDC}" if passed else f"{RED}FAIL{ENDC}"
+    print(f"{status_line}  {YELLOW}{name}{ENDC} {detail}")
+    all_results.append(passed)
+
+def start_worker(port):
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+        env={**os.environ, "CHANGE_FEED": "1", "STARTUP_WARMUP": "0"},
+    )
+
+async def wait_until_listening(client, deadline):
+    while time.perf_counter() < deadline:
+        try:
+            resp = await client.get("/readyz")
+            if resp.status_code == 200 and resp.json().get("changeFeed") == "listening":
+                return True
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.05)
+    return False
+
+async def seed():
+    users = []
+    for i in range(3):
+        clerk_id = f"feed_user_{uuid4().hex[:8]}_{i}"
+        users.append(await db.user.create(data={"clerkUserId": clerk_id, "name": f"Feed {i}", "email": f"{clerk_id}@test.com"}))
+    business = await db.business.create(data={"id": str(uuid4()), "name": "Feed test", "ownerId": users[0].id})
+    queue = await db.queue.create(data={"id": str(uuid4()), "title": "Feed queue", "businessId": business.id})
+    return queue.id, [u.id for u in users]
+
+async def read_events(stream, count):
+    """The next `count` SSE data messages from an open stream response."""
+    events = []
+    async for line in stream.aiter_lines():
+        if line.startswith("data: "):
+            events.append(json.loads(line[len("data: "):]))
+            if len(events) == count:
+                return events
+    return events
+
+async def main():
+    await db.connect()
+    queue_id, user_ids = await seed()
+    workers = [start_worker(port) for port in PORTS]
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{PORTS[0]}", timeout=30.0) as a, \
+                   httpx.AsyncClient(base_url=f"http://127.0.0.1:{PORTS[1]}", timeout=30.0) as b:
+            deadline = time.perf_counter() + 60
+            if not all([await wait_until_listening(a, deadline), await wait_until_listening(b, deadline)]):
+                raise SystemExit("workers did not start listening on the change feed")
+
+            for user_id in user_ids:
+                resp = await a.post(f"/user/queues/{queue_id}/join/{user_id}")
+                assert resp.status_code == 200, resp.text
+            last = user_ids[-1]
+
+            # Worker B streams the last customer's position while worker A serves the queue
+            async with b.stream("GET", f"/user/queues/{queue_id}/stream/{last}") as stream:
+                snapshot = (await read_events(stream, 1))[0]
+                record("stream snapshot on worker B", snapshot["position"] == 3, f"position {snapshot['position']}")
+
+                start = time.perf_counter()
+                await a.post(f"/admin/queues/{queue_id}/leave/{user_ids[0]}")
+                await a.post(f"/admin/queues/{queue_id}/next")
+                try:
+                    moves = await asyncio.wait_for(read_events(stream, 2), EVENT_TIMEOUT)
+                except asyncio.TimeoutError:
+                    moves = []
+                elapsed = (time.perf_counter() - start) * 1000
+                positions = [event["position"] for event in moves]
+                record(
+                    "worker B sees leave and call-next from worker A",
+                    positions == [2, 1],
+                    f"positions {positions} after {elapsed:.0f} ms",
+                )
+
+            # Worker B caches the queue, worker A closes it, worker B must drop its copy
+            cached = (await b.get(f"/admin/queues/{queue_id}")).json()
+            await a.post(f"/admin/queues/{queue_id}/close")
+            closed = None
+            deadline = time.perf_counter() + EVENT_TIMEOUT
+            while time.perf_counter() < deadline:
+                closed = (await b.get(f"/admin/queues/{queue_id}")).json()["queue"]["closedAt"]
+                if closed:
+                    break
+                await asyncio.sleep(0.05)
+            record(
+                "worker B drops cached queue closed on worker A",
+                cached["queue"]["closedAt"] is None and closed is not None,
+                f"closedAt {closed}",
+            )
+    finally:
+        for worker in workers:
+            worker.terminate()
+            worker.wait()
+        await db.disconnect()
+
+    passed = sum(all_results)
+    print(f"\n{YELLOW}TOTAL: {len(all_results)} | PASSED: {passed} | FAILED: {len(all_results) - passed}{ENDC}")
+    return passed == len(all_results)
+
+if __name__ == "__main__":
+    sys.exit(0 if asyncio.run(main()) else 1)
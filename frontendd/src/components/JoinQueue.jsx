@@ -1,20 +1,73 @@
-import React, { useState } from 'react';
+import React, { useEffect, useState } from 'react';
+
+const API_URL = import.meta.env.VITE_API_URL || 'http://localhost:8000';
 
 const JoinQueue = () => {
   const [businessName, setBusinessName] = useState('');
   const [queueId, setQueueId] = useState('');
+  const [userId, setUserId] = useState('');
   const [showTicket, setShowTicket] = useState(false);
+  const [position, setPosition] = useState(null);
+  const [ticketStatus, setTicketStatus] = useState('waiting');
+  const [error, setError] = useState('');
 
-  const handleJoinQueue = () => {
-    if (businessName.trim() && queueId.trim()) {
+  const handleJoinQueue = async () => {
+    if (!(businessName.trim() && queueId.trim() && userId.trim())) return;
+    setError('');
+    let res;
+    try {
+      res = await fetch(`${API_URL}/user/queues/${queueId}/join/${userId}`, { method: 'POST' });
+    } catch {
+      setError('Could not reach the server. Please try again.');
+      return;
+    }
+    if (res.ok) {
       setShowTicket(true);
+      return;
+    }
+
+    const body = await res.json().catch(() => ({}));
+    const detail = typeof body.detail === 'string' ? body.detail : '';
+    if (res.status === 400 && detail.startsWith('User already joined')) {
+      // This user already holds a ticket, which the stream will show
+      setShowTicket(true);
+    } else if (res.status === 400 && detail.startsWith('Queue is closed')) {
+      setError('This queue is closed and no longer takes new people.');
+    } else if (res.status === 429) {
+      const retryAfter = res.headers.get('Retry-After');
+      setError(`The queue is busy right now. Please try again${retryAfter ? ` in ${retryAfter}s` : ' shortly'}.`);
+    } else {
+      setError(detail || 'Could not join the queue. Please try again.');
     }
   };
 
+  // The server pushes a new position only when someone ahead leaves or is served
+  useEffect(() => {
+    if (!showTicket) return undefined;
+    const source = new EventSource(`${API_URL}/user/queues/${queueId}/stream/${userId}`);
+    source.onmessage = (event) => {
+      const update = JSON.parse(event.data);
+      setPosition(update.position);
+      setTicketStatus(update.status);
+      if (update.status !== 'waiting') source.close();
+    };
+    source.onerror = () => {
+      // EventSource retries dropped connections by itself; CLOSED means the server refused the stream
+      if (source.readyState === EventSource.CLOSED) {
+        setError('Live updates are unavailable for this ticket.');
+      }
+    };
+    return () => source.close();
+  }, [showTicket, queueId, userId]);
+
   const handleCloseTicket = () => {
     setShowTicket(false);
     setBusinessName('');
     setQueueId('');
+    setUserId('');
+    setPosition(null);
+    setTicketStatus('waiting');
+    setError('');
   };
 
   return (
@@ -64,13 +117,28 @@ const JoinQueue = () => {
                 placeholder="Enter queue ID"
               />
             </div>
+
+            <div>
+              <label className="block mb-1 text-gray-300">User ID</label>
+              <input
+                type="text"
+                value={userId}
+                onChange={(e) => setUserId(e.target.value)}
+                className="w-full px-4 py-2 rounded-md bg-gray-800 border border-white/10 text-white placeholder-gray-500 focus:outline-none focus:ring-2 focus:ring-white/20"
+                placeholder="Enter your user ID"
+              />
+            </div>
           </div>
 
+          {error && (
+            <p className="text-red-400 text-sm text-center">{error}</p>
+          )}
+
           {/* Join Button */}
           <div className="flex justify-center pt-4">
             <button
               onClick={handleJoinQueue}
-              disabled={!businessName || !queueId || showTicket}
+              disabled={!businessName || !queueId || !userId || showTicket}
               className={`
                 relative px-8 py-4 font-bold rounded-xl
                 bg-gray-900 border border-white/20 text-white
@@ -124,8 +192,17 @@ const JoinQueue = () => {
               </div>
               <div className="flex justify-between items-center py-2 border-b border-white/10">
                 <span className="text-gray-400">Your Position:</span>
-                <span className="text-white font-semibold">7</span>
+                <span className="text-white font-semibold">{position ?? '...'}</span>
               </div>
+              {error && (
+                <p className="text-red-400 text-sm">{error}</p>
+              )}
+              {ticketStatus !== 'waiting' && (
+                <div className="flex justify-between items-center py-2 border-b border-white/10">
+                  <span className="text-gray-400">Status:</span>
+                  <span className="text-white font-semibold">{ticketStatus}</span>
+                </div>
+              )}
             </div>
 
             {/* Close Button */}